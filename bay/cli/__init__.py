@@ -13,6 +13,7 @@ from .tasks import RootTask
 from ..config import Config
 from ..constants import PluginHook
 from ..docker.hosts import HostManager
+from ..docker.introspect import FormationSnapshot
 from ..exceptions import DockerNotAvailableError
 from ..containers.graph import ContainerGraph
 from ..containers.profile import NullProfile, Profile
@@ -30,9 +31,13 @@ class App(object):
     Also contains a "catalog" system, which allows registration of "catalog types"
     and "catalog items", which is similar to the Python entrypoint system but tied
     to Bay plugins instead so we can have conditional loading/ordered loading.
+
+    Also keeps a snapshot of the formation running on each host for the
+    duration of the command (see formation_snapshot).
     """
     cli = attr.ib()
     plugins = attr.ib(default=attr.Factory(dict), init=False)
+    formation_snapshots = attr.ib(default=attr.Factory(dict), init=False, repr=False)
 
     @classmethod
     def get_default_containers(cls):
@@ -170,6 +175,16 @@ class App(object):
         """
         return self.plugins[klass]
 
+    def formation_snapshot(self, host):
+        """
+        Returns the FormationSnapshot for the host, shared by everything that
+        runs as part of this command.
+        """
+        try:
+            return self.formation_snapshots[host.alias]
+        except KeyError:
+            return self.formation_snapshots.setdefault(host.alias, FormationSnapshot(host, self.containers))
+
     def invoke(self, command_name, **kwargs):
         """
         Runs a [sub]command by name, passing context automatically.
@@ -208,6 +223,19 @@ class AppGroup(SpellcheckableAliasableGroup):
         except requests.exceptions.ReadTimeout:
             click.echo(YELLOW("Transient Docker connection error, please try again."))
             sys.exit(1)
+        finally:
+            self.report_client_cache()
+
+    def report_client_cache(self):
+        """
+        Prints Docker client cache hit rates, if configured to.
+        """
+        config = getattr(self.app, "config", None)
+        if config is None or not config["bay"]["report_client_cache"]:
+            return
+        for host in self.app.hosts:
+            for line in host.client_cache.report():
+                click.echo(PURPLE("[{}] {}".format(host.alias, line)), err=True)
 
 
 @click.command(cls=AppGroup, app_class=App)
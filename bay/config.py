@@ -21,10 +21,18 @@ class Config(object):
         "bay": {
             "home": str,
             "build_log_path": str,
+            "boot_history_path": str,
+            "stop_history_path": str,
             "user_data_path": str,
             "user_profile_home": str,
             "ssh_agent_container": str,
             "port_proxy_container": str,
+            "max_workers": int,
+            "infer_healthcheck_waits": bool,
+            "boot_timeout": int,
+            "report_client_cache": bool,
+            "api_version_cache_path": str,
+            "api_version_cache_ttl": int,
         }
     }
 
@@ -35,10 +43,21 @@ class Config(object):
         "bay": {
             "home": os.path.expanduser(os.environ.get("BAY_HOME", ".")),
             "build_log_path": os.path.expanduser('~/.bay/{prefix}/build.log'),
+            "boot_history_path": os.path.expanduser('~/.bay/{prefix}/boot_history.json'),
+            "stop_history_path": os.path.expanduser('~/.bay/{prefix}/stop_history.json'),
             "user_data_path": os.path.expanduser('~/.bay/{prefix}'),
             "user_profile_home": os.path.expanduser('~/.bay'),
             "ssh_agent_container": "tugboat/ssh-agent",
             "port_proxy_container": "tugboat/port-proxy",
+            "max_workers": int(os.environ.get("BAY_MAX_WORKERS", 16)),
+            "infer_healthcheck_waits": False,
+            # Seconds a container may take to boot before it's considered failed; 0 means no limit
+            "boot_timeout": int(os.environ.get("BAY_BOOT_TIMEOUT", 0)),
+            # Print how often Docker calls were answered from the cache when each command finishes
+            "report_client_cache": bool(os.environ.get("BAY_REPORT_CLIENT_CACHE")),
+            # Where to remember each Docker host's API version, and for how many seconds (0 to always ask)
+            "api_version_cache_path": os.path.expanduser('~/.bay/docker_api_versions.json'),
+            "api_version_cache_ttl": int(os.environ.get("BAY_API_VERSION_CACHE_TTL", 3600)),
         },
     }
 
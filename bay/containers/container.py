@@ -125,6 +125,21 @@ class Container:
             warnings.warn("Old extra_links format in {}".format(self.config_path))
             for link_name in config_extra_links:
                 self.links[link_name] = {"required": False}
+        # Links listed under "early" let us start as soon as the target is running, rather than
+        # once it has finished booting (for services that retry their connections themselves).
+        # early_start applies that to all links.
+        if isinstance(config_links, dict):
+            for link_name in (config_links.get("early") or []):
+                if link_name not in self.links:
+                    raise BadConfigError("Early link {} in {} is not a link".format(link_name, self.config_path))
+                self.links[link_name]["early"] = True
+        self.early_start = config_data.get("early_start", False)
+        # If the container reports its boot progress via towline. None means to look for a
+        # label on the image, and failing that, probe for it while the container boots.
+        # A number says which version of towline it speaks (true is version 1).
+        self.towline = config_data.get("towline", None)
+        if self.towline not in (True, False, None, 1, 2):
+            raise BadConfigError("towline for {} must be true, false, 1 or 2".format(self.path))
         # Parse waits from the config format
         self.waits = []
         for wait_dict in config_data.get("waits", []):
@@ -133,9 +148,13 @@ class Container:
                     # TODO: Deprecate non-dictionary params
                     if wait_type == "time":
                         params = {"seconds": params}
+                    elif wait_type == "log":
+                        params = {"pattern": params}
                     else:
                         params = {"port": params}
                 self.waits.append({"type": wait_type, "params": params})
+        # If a healthcheck wait should be added when the image has a HEALTHCHECK (None means use the global setting)
+        self.infer_healthcheck = config_data.get("infer_healthcheck", None)
         # Volumes is a dict of {container mountpoint: volume name/host path}
         self._bound_volumes = {}
         self._named_volumes = {}
@@ -187,6 +206,14 @@ class Container:
         self.environment = config_data.get("environment", {})
         # Fast kill says if the container is safe to kill immediately
         self.fast_kill = config_data.get("fast_kill", False)
+        # The signal Docker sends to stop the container (None uses the image's STOPSIGNAL, or SIGTERM),
+        # and how many seconds it gets to exit before being killed
+        self.stop_signal = config_data.get("stop_signal", None)
+        self.stop_timeout = config_data.get("stop_timeout", 0 if self.fast_kill else 10)
+        if not isinstance(self.stop_timeout, (int, float)) or self.stop_timeout < 0:
+            raise BadConfigError("stop_timeout for {} must be a number of seconds".format(self.path))
+        # If the container should run with Docker's init as PID 1, so signals are forwarded and handled
+        self.init = config_data.get("init", False)
         # System says if the container is a supporting "system" container, and lives and runs
         # outside of the profiles (e.g. it's ignored by bay restart, or bay up)
         self.system = config_data.get("system", False)
@@ -197,6 +224,17 @@ class Container:
         self.buildargs = {}
         # Store all extra data so plugins can get to it
         self.mem_limit = config_data.get("mem_limit", 0)
+        # How heavy the container is to boot, relative to a typical one; heavier containers take up more
+        # of the concurrent boot capacity
+        self.boot_weight = config_data.get("boot_weight", 1)
+        if not isinstance(self.boot_weight, (int, float)) or self.boot_weight <= 0:
+            raise BadConfigError("boot_weight for {} must be a positive number".format(self.path))
+        # How many seconds the container may take to boot (including waits) before it's considered to have
+        # failed; None means to use the global default, and 0 means no limit
+        self.boot_timeout = config_data.get("boot_timeout", None)
+        valid_timeout = isinstance(self.boot_timeout, (int, float)) and self.boot_timeout >= 0
+        if self.boot_timeout is not None and not valid_timeout:
+            raise BadConfigError("boot_timeout for {} must be a number of seconds".format(self.path))
         self.extra_data = {
             key: value
             for key, value in config_data.items()
@@ -210,6 +248,14 @@ class Container:
                 "volumes",
                 "image_tag",
                 "mem_limit",
+                "boot_weight",
+                "early_start",
+                "towline",
+                "infer_healthcheck",
+                "boot_timeout",
+                "stop_signal",
+                "stop_timeout",
+                "init",
             }
         }
 
@@ -258,6 +304,13 @@ class Container:
         else:
             return []
 
+    def link_starts_early(self, link_name):
+        """
+        Says if this container may start once the linked container is
+        running, rather than waiting for it to finish booting.
+        """
+        return self.early_start or self.links.get(link_name, {}).get("early", False)
+
     def get_named_volume_path(self, volume_name):
         """
         Returns the mount path, given a volume name.
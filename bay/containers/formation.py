@@ -1,4 +1,6 @@
 import attr
+import hashlib
+import json
 import warnings
 
 from ..exceptions import ImageNotFoundException
@@ -112,7 +114,8 @@ class ContainerFormation:
             links=links,
             devmodes=devmodes,
             foreground=container.foreground,
-            environment=container.environment,
+            # Copy so runtime additions from plugins don't leak back into the container definition
+            environment=dict(container.environment),
             mem_limit=container.mem_limit,
         )
         self.add_instance(instance)
@@ -128,6 +131,17 @@ class ContainerFormation:
             new.add_instance(instance.clone())
         return new
 
+    def reverse_links(self):
+        """
+        Returns an index of {instance: set of instances that link to it}, built
+        in a single pass over all the links in the formation.
+        """
+        result = {instance: set() for instance in self}
+        for instance in self:
+            for target in instance.links.values():
+                result.setdefault(target, set()).add(instance)
+        return result
+
     def has_container(self, container):
         """
         Returns True if the formation has an instance running the given container.
@@ -180,8 +194,26 @@ class ContainerInstance:
     :environment: Extra environment variables to set in the container
     :command: A custom command override (as a list of string arguments, like subprocess.call takes)
     :foreground: If True, the container is launched in the foreground and a TTY attached
+    :recorded_config: For running instances, the {field: digest} configuration fingerprint the
+                      container was created with (see config_digests), if it has one
+    :boot_deadline: While the container is booting, the time (as time.time()) it must have finished
+                    by, if it has a boot timeout
     """
 
+    # The fields that make up an instance's configuration, in the order changes are reported
+    config_fields = [
+        "name",
+        "container",
+        "image_id",
+        "links",
+        "devmodes",
+        "ports",
+        "environment",
+        "mem_limit",
+        "command",
+        "process",
+    ]
+
     name = attr.ib(cmp=True)
     container = attr.ib(cmp=False)
     image_id = attr.ib(cmp=False)
@@ -192,6 +224,8 @@ class ContainerInstance:
     mem_limit = attr.ib(default=0, repr=False, cmp=False)
     command = attr.ib(default=None, repr=False, cmp=False)
     foreground = attr.ib(default=None, repr=False, cmp=False)
+    recorded_config = attr.ib(default=None, repr=False, cmp=False)
+    boot_deadline = attr.ib(default=None, init=False, repr=False, cmp=False)
     formation = attr.ib(default=None, init=False, repr=False, cmp=False)
 
     def __attrs_post_init__(self):
@@ -228,26 +262,92 @@ class ContainerInstance:
             mem_limit=self.mem_limit,
             command=self.command,
             foreground=self.foreground,
+            recorded_config=self.recorded_config,
         )
 
+    @property
+    def process(self):
+        """
+        How the container's main process is run and stopped.
+        """
+        return {
+            "init": bool(self.container.init),
+            "stop_signal": self.container.stop_signal,
+        }
+
     def different_from(self, other):
         """
         Returns if the other instance is different from this one at all
         (i.e. we need to stop it and start us)
         """
-        return (
-            self.name != other.name or
-            self.container != other.container or
-            self.image_id != other.image_id or
-            self.links != other.links or
-            self.devmodes != other.devmodes or
-            self.ports != other.ports or
-            self.environment != other.environment or
-            self.mem_limit != other.mem_limit or
-            self.command != other.command or
-            other.foreground or
-            self.foreground
-        )
+        return bool(self.differences(other))
+
+    def differences(self, other):
+        """
+        Returns a list of the names of the fields that differ between this
+        instance and the other one. Foreground instances are always different.
+
+        If either side was created with a configuration fingerprint, the
+        fingerprints are compared rather than the fields themselves, as not
+        everything can be recovered from a running container.
+        """
+        if self.recorded_config is not None or other.recorded_config is not None:
+            ours = self.recorded_config or self.config_digests()
+            theirs = other.recorded_config or other.config_digests()
+            if self.config_hash(ours) == self.config_hash(theirs):
+                result = []
+            else:
+                result = [
+                    field
+                    for field in self.config_fields
+                    if ours.get(field) != theirs.get(field)
+                ] or ["configuration"]
+        else:
+            result = [
+                field
+                for field in self.config_fields
+                if getattr(self, field) != getattr(other, field)
+            ]
+        if self.foreground or other.foreground:
+            result.append("foreground")
+        return result
+
+    def config_digests(self):
+        """
+        Returns a {field: digest} fingerprint of this instance's configuration,
+        built from a canonical JSON form of each field.
+        """
+        canonical = {
+            "name": self.name,
+            "container": self.container.name,
+            "image_id": self.image_id,
+            "links": {
+                "mode": self.formation.graph.link_mode if self.formation is not None else "legacy",
+                "targets": {
+                    alias: target if isinstance(target, str) else target.name
+                    for alias, target in self.links.items()
+                },
+            },
+            "devmodes": sorted(self.devmodes),
+            "ports": {str(key): value for key, value in self.ports.items()},
+            "environment": {str(key): value for key, value in self.environment.items()},
+            "mem_limit": self.mem_limit,
+            "command": self.command,
+            "process": self.process,
+        }
+        return {
+            field: hashlib.sha1(
+                json.dumps(canonical[field], sort_keys=True, default=str).encode("utf8")
+            ).hexdigest()[:16]
+            for field in self.config_fields
+        }
+
+    @staticmethod
+    def config_hash(digests):
+        """
+        Returns a single hash for a set of config_digests.
+        """
+        return hashlib.sha256(json.dumps(digests, sort_keys=True).encode("ascii")).hexdigest()
 
     def resolve_links(self):
         """
@@ -39,6 +39,10 @@ class ContainerGraph:
         self.prefix = None
         self.registry = None
         self.plugin_configuration = dict()
+        # How containers find their links: "legacy" Docker links, or "aliases" on the formation network
+        self.link_mode = "legacy"
+        # Options for creating the formation network (driver, mtu, subnet, gateway)
+        self.network_options = {"driver": "bridge"}
         # Work out the path to the configuration file
         self.config_path = os.path.join(self.path, "bay.yaml")
         if not os.path.isfile(self.config_path):
@@ -57,6 +61,19 @@ class ContainerGraph:
                 self.registry = value
             elif key == "plugin_configuration":
                 self.plugin_configuration = value
+            elif key == "link_mode":
+                if value not in ("legacy", "aliases"):
+                    raise BadConfigError("Invalid link_mode in %s: %s" % (self.config_path, value))
+                self.link_mode = value
+            elif key == "network":
+                if not isinstance(value, dict):
+                    raise BadConfigError("network in %s must be a dict" % self.config_path)
+                for option in value:
+                    if option not in ("driver", "mtu", "subnet", "gateway"):
+                        raise BadConfigError("Unknown network option in %s: %s" % (self.config_path, option))
+                if value.get("gateway") and not value.get("subnet"):
+                    raise BadConfigError("network gateway in %s needs a subnet" % self.config_path)
+                self.network_options.update(value)
             else:
                 raise BadConfigError("Unknown key in %s: %s" % (self.config_path, key))
         if self.prefix is None:
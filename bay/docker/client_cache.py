@@ -0,0 +1,282 @@
+import copy
+import threading
+import types
+from concurrent.futures import Future
+
+from docker.errors import NotFound
+
+from .introspect import FormationIntrospector
+
+
+class DockerCallCache:
+    """
+    Remembers the results of read-only Docker calls for the rest of the
+    command, shared by all of a host's clients, and makes concurrent identical
+    calls share a single request.
+
+    Whenever bay changes something through a CachingClient, what's cached
+    about the objects it changed is forgotten - looked up by name, ID or
+    image tag - or about that whole kind of object (images, containers,
+    volumes or networks) if the call doesn't say which. Streamed calls (like
+    builds and pulls) forget it again once the stream finishes.
+
+    Containers also change on their own, so their inspects are only
+    remembered while the host's event stream is being followed, which tells
+    us when to forget them. The stream only covers bay's containers, so
+    inspects of anything else aren't kept.
+    """
+
+    # Read-only calls we cache, keyed by the first argument, and the kind of object they ask about
+    cached_methods = {
+        "inspect_image": "image",
+        "inspect_container": "container",
+        "inspect_volume": "volume",
+        "inspect_network": "network",
+    }
+
+    # Calls that change things, and the objects they change as (kind, argument position, argument name).
+    # A position of None means it can only be passed by name; no argument at all means any of that kind.
+    # Images named by a "repository" argument get the call's "tag" argument added.
+    invalidating_methods = {
+        "create_container": [("container", None, "name")],
+        "start": [("container", 0, "container")],
+        "stop": [("container", 0, "container")],
+        "kill": [("container", 0, "container")],
+        "restart": [("container", 0, "container")],
+        "pause": [("container", 0, "container")],
+        "unpause": [("container", 0, "container")],
+        "rename": [("container", 0, "container"), ("container", 1, "name")],
+        "update_container": [("container", 0, "container")],
+        "remove_container": [("container", 0, "container")],
+        "prune_containers": [("container", None, None)],
+        "build": [("image", 1, "tag")],
+        "pull": [("image", 0, "repository")],
+        "tag": [("image", 0, "image"), ("image", 1, "repository")],
+        "commit": [("image", 1, "repository")],
+        "import_image": [("image", None, None)],
+        "load_image": [("image", None, None)],
+        "remove_image": [("image", 0, "image")],
+        "prune_images": [("image", None, None)],
+        "create_volume": [("volume", 0, "name")],
+        "remove_volume": [("volume", 0, "name")],
+        "prune_volumes": [("volume", None, None)],
+        "create_network": [("network", 0, "name")],
+        "remove_network": [("network", 0, "net_id")],
+        "prune_networks": [("network", None, None)],
+        "connect_container_to_network": [("container", 0, "container"), ("network", 1, "net_id")],
+        "disconnect_container_from_network": [("container", 0, "container"), ("network", 1, "net_id")],
+    }
+
+    def __init__(self, host):
+        self.host = host
+        self.lock = threading.Lock()
+        # {(method, argument): Future}, including ones still in flight
+        self.entries = {}
+        # {kind: number of times it's been invalidated}, so results that raced an invalidation aren't kept
+        self.generations = {kind: 0 for kind in self.cached_methods.values()}
+        # {method: [hits, misses]}
+        self.stats = {}
+        # Our subscription to the host's events, while we're caching container inspects
+        self.watch_handle = None
+
+    def call(self, client, method, argument):
+        """
+        Returns the result of client.method(argument), from the cache if we can.
+        """
+        kind = self.cached_methods[method]
+        key = (method, argument)
+        with self.lock:
+            stats = self.stats.setdefault(method, [0, 0])
+            future = self.entries.get(key)
+            if kind == "container" and not self._following_events():
+                # We wouldn't know when to forget it
+                stats[1] += 1
+                future = None
+                owner = None
+            elif future is not None:
+                stats[0] += 1
+                owner = False
+            else:
+                stats[1] += 1
+                future = self.entries[key] = Future()
+                generation = self.generations[kind]
+                owner = True
+        if owner is None:
+            return getattr(client, method)(argument)
+        # Someone else is (or was) fetching it; wait for them. Everyone gets their own copy to change.
+        if not owner:
+            return copy.deepcopy(future.result())
+        try:
+            future.set_result(getattr(client, method)(argument))
+        except NotFound as e:
+            # Things not existing is worth remembering too, until something is created
+            future.set_exception(e)
+        except BaseException as e:
+            future.set_exception(e)
+            self._forget(key, future)
+            raise
+        with self.lock:
+            keep = self.generations[kind] == generation
+        if kind == "container" and future.exception() is None:
+            keep = keep and FormationIntrospector.CONTAINER_LABEL in (future.result()["Config"].get("Labels") or {})
+        if not keep:
+            self._forget(key, future)
+        return copy.deepcopy(future.result())
+
+    def _forget(self, key, future):
+        with self.lock:
+            if self.entries.get(key) is future:
+                del self.entries[key]
+
+    def _following_events(self):
+        """
+        Returns True if we're being told about container changes. Must be
+        called with the lock held.
+        """
+        if self.watch_handle is None and self.host.state_mirror.live:
+            # The stream is already open for the state mirror, so listening in is free
+            self.watch_handle = self.host.event_watcher.watch(
+                None,
+                self.on_container_event,
+                events=self.host.event_watcher.events,
+            )
+        return self.watch_handle is not None
+
+    def on_container_event(self, event):
+        """
+        Forgets what we know about a container when something happens to it,
+        or about all of them if we stop being told.
+        """
+        with self.lock:
+            if event is None:
+                self.host.event_watcher.unwatch(None, self.watch_handle)
+                self.watch_handle = None
+                self._invalidate("container")
+                return
+            # Anything in flight may have missed this
+            self.generations["container"] += 1
+            names = {event.get("Actor", {}).get("Attributes", {}).get("name"), event.get("id")}
+            for key in [key for key in self.entries if key[0] == "inspect_container" and key[1] in names]:
+                del self.entries[key]
+
+    @classmethod
+    def changed_by(cls, method, args, kwargs):
+        """
+        Works out what a call to an invalidating method changes, as
+        {kind: set of names and IDs, or None for all of them}.
+        """
+        changed = {}
+        for kind, position, name in cls.invalidating_methods[method]:
+            value = cls._argument(args, kwargs, position, name)
+            if isinstance(value, dict):
+                value = value.get("Id")
+            if value and name == "repository":
+                tag = cls._argument(args, kwargs, position + 1, "tag")
+                if tag:
+                    value = "{}:{}".format(value, tag)
+            if not isinstance(value, str) or not value:
+                changed[kind] = None
+            elif changed.get(kind, set()) is not None:
+                changed.setdefault(kind, set()).update(cls._names(kind, value))
+        return changed
+
+    @staticmethod
+    def _argument(args, kwargs, position, name):
+        if position is not None and position < len(args):
+            return args[position]
+        return kwargs.get(name)
+
+    @staticmethod
+    def _names(kind, value):
+        """
+        Returns the names the object could have been looked up by.
+        """
+        names = {value}
+        # Untagged image names mean the latest tag
+        if kind == "image" and not value.startswith("sha256:") and ":" not in value.rsplit("/", 1)[-1]:
+            names.add(value + ":latest")
+        return names
+
+    def invalidate(self, changed):
+        """
+        Forgets what's cached about changed objects, given as
+        {kind: set of names and IDs, or None for every object of that kind}.
+        """
+        with self.lock:
+            for kind, names in changed.items():
+                self._invalidate(kind, names)
+
+    def _invalidate(self, kind, names=None):
+        self.generations[kind] += 1
+        for key, future in list(self.entries.items()):
+            if self.cached_methods[key[0]] == kind and (names is None or self._describes(key, future, names)):
+                del self.entries[key]
+
+    @staticmethod
+    def _describes(key, future, names):
+        """
+        Says if a cached entry is about any of the named objects, either by
+        what it was looked up as or by the name, ID or tags it came back with.
+        """
+        if key[1] in names:
+            return True
+        if not future.done() or future.exception() is not None:
+            return False
+        result = future.result()
+        return bool(
+            result.get("Id") in names or
+            (result.get("Name") or "").lstrip("/") in names or
+            names.intersection(result.get("RepoTags") or [])
+        )
+
+    def report(self):
+        """
+        Returns a line per cached call type saying how often the cache was used.
+        """
+        with self.lock:
+            stats = sorted(self.stats.items())
+        return [
+            "{}: {} of {} calls from cache ({:.0%})".format(method, hits, hits + misses, hits / (hits + misses))
+            for method, (hits, misses) in stats
+        ]
+
+
+class CachingClient:
+    """
+    Wraps a Docker APIClient so read-only inspects go through the host's
+    DockerCallCache and calls that change things invalidate it. Everything
+    else is passed straight through.
+    """
+
+    def __init__(self, client, cache):
+        self._client = client
+        self._cache = cache
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if name in DockerCallCache.cached_methods:
+            def cached(argument, *args, **kwargs):
+                # Only plain lookups by name or ID are cached
+                if args or kwargs or not isinstance(argument, str):
+                    return attribute(argument, *args, **kwargs)
+                return self._cache.call(self._client, name, argument)
+            return cached
+        if name in DockerCallCache.invalidating_methods:
+            def invalidating(*args, **kwargs):
+                changed = DockerCallCache.changed_by(name, args, kwargs)
+                try:
+                    result = attribute(*args, **kwargs)
+                finally:
+                    self._cache.invalidate(changed)
+                # Streamed calls are still making their change until the stream is done
+                if isinstance(result, types.GeneratorType):
+                    return self._invalidate_after(result, changed)
+                return result
+            return invalidating
+        return attribute
+
+    def _invalidate_after(self, stream, changed):
+        try:
+            yield from stream
+        finally:
+            self._cache.invalidate(changed)
@@ -0,0 +1,295 @@
+import itertools
+import threading
+import time
+import traceback
+import warnings
+
+from docker.errors import APIError
+from requests.exceptions import RequestException
+
+from .introspect import FormationIntrospector
+
+
+class ContainerEventWatcher:
+    """
+    Follows a host's Docker event stream in a background thread, calling back
+    anything that's interested in a particular container (or in all of them)
+    when something happens to it, like it dying or its health status changing.
+
+    The stream is only opened once something starts watching. If it breaks,
+    watchers are called back with None so they can fall back to polling, and
+    the next call to watch opens it again.
+    """
+
+    # Event types we follow; health_status events have actions like "health_status: healthy"
+    events = ["create", "start", "die", "destroy", "health_status"]
+
+    # Only bay's own containers are followed, so busy hosts don't flood us with other events. (Docker's
+    # "network" filter only matches network events, so it can't narrow container events to a formation.)
+    filters = {
+        "type": "container",
+        "event": events,
+        "label": [FormationIntrospector.CONTAINER_LABEL],
+    }
+
+    def __init__(self, host):
+        self.host = host
+        self.lock = threading.Lock()
+        # {container name: {handle: (callback, event types)}}
+        self.watchers = {}
+        self.handle_counter = itertools.count()
+        self.thread = None
+        # Set while the stream is open, so anything that needs to see every event from a point can wait for it
+        self.connected = threading.Event()
+
+    def watch(self, name, callback, events=("die",)):
+        """
+        Calls callback(event) when one of the given types of event happens to the
+        named container (or any container, if name is None). Returns a handle to
+        pass to unwatch.
+        """
+        with self.lock:
+            handle = next(self.handle_counter)
+            self.watchers.setdefault(name, {})[handle] = (callback, set(events))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.follow, daemon=True)
+                self.thread.start()
+        return handle
+
+    def unwatch(self, name, handle):
+        with self.lock:
+            callbacks = self.watchers.get(name, {})
+            callbacks.pop(handle, None)
+            if not callbacks:
+                self.watchers.pop(name, None)
+
+    def follow(self):
+        """
+        Reads the event stream, dispatching events to watchers.
+        """
+        try:
+            stream = self.host.client.events(decode=True, filters=self.filters)
+            self.connected.set()
+            for event in stream:
+                name = event.get("Actor", {}).get("Attributes", {}).get("name")
+                event_type = (event.get("Action") or event.get("status") or "").split(":", 1)[0]
+                # Watchers of every container (like the state mirror) go first, so the others see their updates
+                with self.lock:
+                    callbacks = [
+                        callback
+                        for watched_name in (None, name)
+                        for callback, events in self.watchers.get(watched_name, {}).values()
+                        if event_type in events
+                    ]
+                for callback in callbacks:
+                    self.run_callback(callback, event)
+        except (APIError, RequestException):
+            pass
+        except Exception:
+            warnings.warn("Stopped following Docker events:\n{}".format(traceback.format_exc()))
+        finally:
+            # The stream went away (or we did); tell everyone, and let the next watch start it again
+            with self.lock:
+                self.thread = None
+                self.connected.clear()
+                callbacks = [callback for callbacks in self.watchers.values() for callback, _ in callbacks.values()]
+            for callback in callbacks:
+                self.run_callback(callback, None)
+
+    @staticmethod
+    def run_callback(callback, event):
+        """
+        Calls a watcher back, making sure one broken watcher can't stop the
+        others hearing about events.
+        """
+        try:
+            callback(event)
+        except Exception:
+            warnings.warn("Error handling Docker event {!r}:\n{}".format(event, traceback.format_exc()))
+
+
+class HostStateMirror:
+    """
+    Keeps an in-memory copy of which of a host's bay containers exist and are
+    running, seeded from one container list and then kept up to date from the
+    host's event stream, so the hot checks during a run (towline, waits, the
+    start and stop entry checks) don't each cost an inspect.
+
+    Events arrive a moment after the change they describe, so state() only
+    ever vouches for a container being running; for anything else, or if the
+    stream isn't being followed, it returns None and callers ask Docker.
+    Changes bay makes itself are recorded straight away, and older events
+    for that container are ignored until the one for the change turns up.
+    """
+
+    RUNNING = "running"
+    STOPPED = "stopped"
+    MISSING = "missing"
+
+    # Container events that change the state we track, and the state they leave the container in
+    transitions = {
+        "create": STOPPED,
+        "start": RUNNING,
+        "die": STOPPED,
+        "destroy": MISSING,
+    }
+
+    # How long to wait for the event stream to open before giving up
+    CONNECT_TIMEOUT = 2
+    # How long to leave it after losing the stream before trying to follow it again
+    RETRY_INTERVAL = 5
+    # How often wait_for_state checks in with Docker when it can't rely on events
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, host, watcher):
+        self.host = host
+        self.watcher = watcher
+        self.condition = threading.Condition()
+        # {container name: state}, only meaningful while live
+        self.states = {}
+        # {container name: state} for changes bay recorded whose event hasn't arrived yet
+        self.expected = {}
+        self.live = False
+        self.handle = None
+        # Fills the mirror in the background once start is called
+        self.seed_thread = None
+        # (name, state, recorded) changes that arrive while we're listing the containers, to apply on top of it
+        self.pending = None
+        self.retry_after = 0
+
+    def start(self):
+        """
+        Starts mirroring the host's state in the background if we aren't
+        already. Returns True if the mirror is live; until it is, state()
+        returns None and callers ask Docker.
+        """
+        with self.condition:
+            if self.live:
+                return True
+            if self.handle is not None or time.time() < self.retry_after:
+                return False
+            # Subscribe before listing, so nothing that happens in between is missed
+            self.pending = []
+            handle = self.handle = self.watcher.watch(None, self.on_event, events=list(self.transitions))
+            self.seed_thread = threading.Thread(target=self.seed, args=(handle, ), daemon=True)
+            self.seed_thread.start()
+        return False
+
+    def seed(self, handle):
+        """
+        Waits for the event stream to open, then fills the mirror from a
+        container list and goes live.
+        """
+        deadline = time.time() + self.CONNECT_TIMEOUT
+        while not self.watcher.connected.wait(0.1):
+            if self.handle != handle or time.time() >= deadline:
+                self.on_event(None)
+                return
+        try:
+            containers = self.host.client.containers(
+                all=True,
+                filters={"label": FormationIntrospector.CONTAINER_LABEL},
+            )
+        except (APIError, RequestException):
+            self.on_event(None)
+            return
+        with self.condition:
+            if self.handle != handle:
+                return
+            self.states = {}
+            self.expected = {}
+            for details in containers:
+                running = details.get("State") == "running" or details.get("Status", "").startswith("Up")
+                self.states[details["Names"][0].lstrip("/")] = self.RUNNING if running else self.STOPPED
+            for change in self.pending:
+                self.apply(*change)
+            self.pending = None
+            self.live = True
+            self.condition.notify_all()
+
+    def on_event(self, event):
+        """
+        Called by the event watcher with each event, or None if the stream is lost.
+        """
+        with self.condition:
+            if event is None:
+                if self.handle is not None:
+                    self.watcher.unwatch(None, self.handle)
+                self.handle = None
+                self.live = False
+                self.states = {}
+                self.expected = {}
+                self.pending = None
+                self.retry_after = time.time() + self.RETRY_INTERVAL
+                self.condition.notify_all()
+                return
+            attributes = event.get("Actor", {}).get("Attributes", {})
+            event_type = (event.get("Action") or event.get("status") or "").split(":", 1)[0]
+            # Only bay's containers were in the list we started from
+            if FormationIntrospector.CONTAINER_LABEL in attributes and event_type in self.transitions:
+                self.change(attributes.get("name"), self.transitions[event_type], recorded=False)
+
+    def record(self, name, state):
+        """
+        Tells the mirror about a change bay just made to a container (one of
+        RUNNING, STOPPED or MISSING), so it doesn't report the old state
+        until the event arrives.
+        """
+        with self.condition:
+            if self.live or self.pending is not None:
+                self.change(name, state, recorded=True)
+
+    def change(self, name, state, recorded):
+        """
+        Applies a change now, or after the container list if we're still
+        fetching it. Must be called with the condition held.
+        """
+        if self.pending is not None:
+            self.pending.append((name, state, recorded))
+        else:
+            self.apply(name, state, recorded)
+        self.condition.notify_all()
+
+    def apply(self, name, state, recorded):
+        if recorded:
+            self.expected[name] = state
+        elif name in self.expected:
+            # Anything before the event for bay's own change is out of date
+            if self.expected[name] != state:
+                return
+            del self.expected[name]
+        self.states[name] = state
+
+    def state(self, name):
+        """
+        Returns RUNNING if the named container is known to be running, or None
+        if Docker needs to be asked.
+        """
+        with self.condition:
+            if self.live and self.states.get(name) == self.RUNNING:
+                return self.RUNNING
+        return None
+
+    def wait_for_state(self, name, running, timeout):
+        """
+        Blocks until the named container is (or isn't) running, for up to
+        timeout seconds. Wakes as soon as the event arrives if the mirror is
+        live, and polls Docker otherwise. Returns True if the state was reached.
+        """
+        deadline = time.time() + timeout
+        while True:
+            with self.condition:
+                if self.live and name in self.states:
+                    if (self.states[name] == self.RUNNING) == running:
+                        return True
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                    continue
+            if self.host.container_running(name, ignore_exists=True) == running:
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.POLL_INTERVAL, remaining))
@@ -0,0 +1,134 @@
+import json
+import os
+import statistics
+import threading
+
+import attr
+
+
+@attr.s
+class SampleHistory:
+    """
+    Persistent record of the last few measurements of something about each
+    container on this machine, stored per prefix.
+    Subclasses say what's measured and what the samples mean.
+    """
+
+    path = attr.ib()
+    samples = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    new_samples = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    lock = attr.ib(default=attr.Factory(threading.Lock), init=False, repr=False)
+
+    # The bay config key with the path the samples are kept at
+    config_key = None
+    # How many samples to keep per container
+    MAX_SAMPLES = 5
+
+    def __attrs_post_init__(self):
+        self.samples = self._read()
+
+    @classmethod
+    def for_app(cls, app):
+        return cls(app.config.get_path("bay", cls.config_key, app))
+
+    def _read(self):
+        try:
+            with open(self.path, "r") as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(data, dict):
+            return {}
+        return data
+
+    def record(self, container_name, value):
+        """
+        Records a single sample for the named container.
+        """
+        with self.lock:
+            self.new_samples.setdefault(container_name, []).append(value)
+            samples = self.samples.setdefault(container_name, [])
+            samples.append(value)
+            del samples[:-self.MAX_SAMPLES]
+
+    def recent(self, container_name):
+        """
+        Returns the most recent samples for the named container, oldest first.
+        """
+        with self.lock:
+            return list(self.samples.get(container_name, []))
+
+    def save(self):
+        """
+        Writes any new samples to disk, merging with whatever is there now so
+        concurrent runs (e.g. boot containers) don't drop each other's data.
+        """
+        with self.lock:
+            if not self.new_samples:
+                return
+            data = self._read()
+            for container_name, values in self.new_samples.items():
+                samples = data.get(container_name)
+                if not isinstance(samples, list):
+                    samples = []
+                samples.extend(values)
+                data[container_name] = samples[-self.MAX_SAMPLES:]
+            self.new_samples = {}
+            self.samples = data
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temporary_path = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(temporary_path, "w") as fh:
+            json.dump(data, fh)
+        os.replace(temporary_path, self.path)
+
+
+class BootHistory(SampleHistory):
+    """
+    How long each container has taken to boot (from container creation to
+    the end of its waits), in seconds.
+
+    Used to estimate which dependency chains are the slowest so they can be
+    started first.
+    """
+
+    config_key = "boot_history_path"
+    # Seconds to assume for a container we have never seen boot
+    DEFAULT_DURATION = 1.0
+
+    def estimate(self, container_name):
+        """
+        Returns the expected boot duration for the named container in seconds.
+        Unknown containers are assumed to take as long as a typical known one.
+        """
+        with self.lock:
+            samples = self.samples.get(container_name)
+            if samples:
+                return statistics.median(samples)
+            known = [statistics.median(values) for values in self.samples.values() if values]
+        if known:
+            return statistics.median(known)
+        return self.DEFAULT_DURATION
+
+
+class StopHistory(SampleHistory):
+    """
+    Whether each container's graceful stops ran out of time and it had to be
+    killed, so the ones that never exit on their own can be pointed out.
+    """
+
+    config_key = "stop_history_path"
+
+    def record(self, container_name, killed):
+        """
+        Records whether a graceful stop of the named container ended in it
+        being killed.
+        """
+        super().record(container_name, bool(killed))
+
+    def keeps_getting_killed(self, container_name, threshold):
+        """
+        Says if the named container was killed on its last stop, and on at
+        least threshold of its recent ones.
+        """
+        recent = self.recent(container_name)
+        return bool(recent and recent[-1] and sum(recent) >= threshold)
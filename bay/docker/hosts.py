@@ -1,14 +1,23 @@
 import attr
 import docker
 import os
+import requests
 import sys
 import urllib.parse
 import json
 import subprocess
+import threading
+import time
 from distutils.version import LooseVersion
 
+from docker.constants import DEFAULT_NUM_POOLS
+from docker.transport import UnixAdapter
+from docker.transport.unixconn import UnixHTTPConnectionPool
+
 from ..exceptions import DockerNotAvailableError
 from ..utils.functional import cached_property, thread_cached_property
+from .client_cache import CachingClient, DockerCallCache
+from .events import ContainerEventWatcher, HostStateMirror
 from .images import ImageRepository
 
 
@@ -27,7 +36,13 @@ class HostManager(object):
     @classmethod
     def from_config(cls, config):
         return cls([
-            Host.from_env(),
+            Host.from_env(
+                pool_size=config["bay"]["max_workers"],
+                api_versions=ApiVersionCache(
+                    os.path.expanduser(config["bay"]["api_version_cache_path"]),
+                    ttl=config["bay"]["api_version_cache_ttl"],
+                ),
+            ),
         ])
 
     def add_host(self, host):
@@ -52,8 +67,17 @@ class Host(object):
     tls_ca = attr.ib()
     tls_cert = attr.ib()
     tls_key = attr.ib()
+    # How many idle connections to the host to keep open for reuse
+    pool_size = attr.ib(default=16, repr=False)
+    # Where to remember the host's API version between commands, if anywhere
+    api_versions = attr.ib(default=None, repr=False, cmp=False)
     url_scheme = attr.ib(init=False)
     url_location = attr.ib(init=False)
+    event_watcher = attr.ib(init=False, repr=False, cmp=False)
+    state_mirror = attr.ib(init=False, repr=False, cmp=False)
+    client_cache = attr.ib(init=False, repr=False, cmp=False)
+    _client = attr.ib(default=None, init=False, repr=False, cmp=False)
+    _client_lock = attr.ib(default=attr.Factory(threading.Lock), init=False, repr=False, cmp=False)
 
     def __attrs_post_init__(self):
         # Parse URL into components
@@ -62,11 +86,18 @@ class Host(object):
         self.url_location = parse_result.netloc
         if self.url_scheme not in ["unix", "tcp"]:
             raise ValueError("Unknown scheme in Docker URL %s" % self.url)
+        # Shared follower of the host's event stream (only connects once something watches)
+        self.event_watcher = ContainerEventWatcher(self)
+        # Event-driven copy of which containers are running (only used once something starts it)
+        self.state_mirror = HostStateMirror(self, self.event_watcher)
+        # Results of read-only calls, shared by everything using the client
+        self.client_cache = DockerCallCache(self)
 
     @classmethod
-    def from_env(cls, alias="default"):
+    def from_env(cls, alias="default", **kwargs):
         """
-        Makes a host from Docker environment variables.
+        Makes a host from Docker environment variables. Any other settings
+        are passed through.
         """
         tls_ca = tls_cert = tls_key = None
         if "DOCKER_CERT_PATH" in os.environ:
@@ -79,6 +110,7 @@ class Host(object):
             tls_ca=tls_ca,
             tls_cert=tls_cert,
             tls_key=tls_key,
+            **kwargs
         )
 
     @cached_property
@@ -113,10 +145,47 @@ class Host(object):
         """
         return not self.publicly_visible
 
-    @thread_cached_property
+    @property
     def client(self):
         """
-        Returns a Docker client for the URL
+        Returns the Docker client for the URL, shared by all threads, with
+        read-only calls cached for the rest of the command (see DockerCallCache).
+        """
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self.make_client()
+        return self._client
+
+    def make_client(self):
+        """
+        Makes a Docker client for the URL, reusing the API version we
+        negotiated last time if it's recent enough.
+        """
+        api_version = self.api_versions.get(self.url) if self.api_versions else None
+        if api_version:
+            # The host may not support it any more (e.g. Docker was downgraded), so be ready to ask again
+            client = RememberedVersionClient(self.make_api_client(api_version), self.renegotiate_api_version)
+        else:
+            client = self.make_api_client("auto")
+            if self.api_versions:
+                self.api_versions.set(self.url, client.api_version)
+        return CachingClient(client, self.client_cache)
+
+    def renegotiate_api_version(self):
+        """
+        Forgets the remembered API version and makes a new Docker client
+        that asks the host which one to use.
+        """
+        self.api_versions.forget(self.url)
+        client = self.make_api_client("auto")
+        self.api_versions.set(self.url, client.api_version)
+        return client
+
+    def make_api_client(self, api_version):
+        """
+        Makes a plain Docker API client for the URL that uses the given API
+        version ("auto" to ask the host).
         """
         # TLS setup
         tls = None
@@ -131,14 +200,31 @@ class Host(object):
             )
         # Make client
         try:
-            return docker.APIClient(
+            client = docker.APIClient(
                 base_url=self.url,
-                version="auto",
+                version=api_version,
                 timeout=os.getenv('BAY_HTTP_TIMEOUT', 60),
                 tls=tls,
             )
         except docker.errors.DockerException:
             raise DockerNotAvailableError("The docker host at {} is not available".format(self.url))
+        self.size_connection_pools(client)
+        return client
+
+    def size_connection_pools(self, client):
+        """
+        Lets each of the client's connection pools keep pool_size connections
+        alive, so every worker thread sharing it can reuse one. This doesn't
+        cap how many can be open at once, as streaming calls like events and
+        logs hold theirs indefinitely.
+        """
+        for prefix, adapter in list(client.adapters.items()):
+            if isinstance(adapter, UnixAdapter):
+                # Unix socket pools are made by the adapter itself, not a pool manager
+                client.mount(prefix, SizedUnixAdapter(adapter.socket_path, adapter.timeout, maxsize=self.pool_size))
+                adapter.close()
+            elif isinstance(adapter, requests.adapters.HTTPAdapter):
+                adapter.init_poolmanager(DEFAULT_NUM_POOLS, self.pool_size)
 
     @thread_cached_property
     def images(self):
@@ -151,6 +237,8 @@ class Host(object):
         """
         Shortcut to see if a container exists with the given runtime name
         """
+        if self.state_mirror.state(name) == HostStateMirror.RUNNING:
+            return True
         try:
             self.client.inspect_container(name)
             return True
@@ -162,6 +250,8 @@ class Host(object):
         Says if the named container is running or not. Errors if you provide
         a container that does not exist.
         """
+        if self.state_mirror.state(name) == HostStateMirror.RUNNING:
+            return True
         if ignore_exists and not self.container_exists(name):
             return False
         data = self.client.inspect_container(name)
@@ -235,3 +325,125 @@ class Host(object):
             return LooseVersion(base_version) >= LooseVersion("17.05.0")
         else:
             return False
+
+
+class SizedUnixAdapter(UnixAdapter):
+    """
+    docker's UnixAdapter, but making connection pools that keep more than the
+    default 10 connections alive.
+    """
+
+    __attrs__ = UnixAdapter.__attrs__ + ["maxsize"]
+
+    def __init__(self, socket_url, timeout=60, maxsize=10, **kwargs):
+        self.maxsize = maxsize
+        super().__init__(socket_url, timeout, **kwargs)
+
+    def get_connection(self, url, proxies=None):
+        with self.pools.lock:
+            pool = self.pools.get(url)
+            if pool is None:
+                pool = self.pools[url] = UnixHTTPConnectionPool(
+                    url,
+                    self.socket_path,
+                    self.timeout,
+                    maxsize=self.maxsize,
+                )
+        return pool
+
+
+class RememberedVersionClient:
+    """
+    Wraps a Docker APIClient made with a remembered API version. If the host
+    says that version is too new for it, the client is swapped for one that
+    negotiates a version afresh and the call is retried.
+    """
+
+    def __init__(self, client, renegotiate):
+        self._client = client
+        self._renegotiate = renegotiate
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_version_error(error):
+        message = str(error).lower()
+        return "too new" in message or "newer than server" in message
+
+    def __getattr__(self, name):
+        client = self._client
+        attribute = getattr(client, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            try:
+                return attribute(*args, **kwargs)
+            except docker.errors.APIError as error:
+                if not self.is_version_error(error):
+                    raise
+            with self._lock:
+                # Only renegotiate once, however many calls failed at the same time
+                if self._client is client:
+                    self._client = self._renegotiate()
+            return getattr(self._client, name)(*args, **kwargs)
+        return call
+
+
+@attr.s
+class ApiVersionCache:
+    """
+    Remembers the API version negotiated with each Docker host for a while,
+    so new clients don't have to ask the host for it every time. A ttl of 0
+    turns it off.
+    """
+
+    path = attr.ib()
+    ttl = attr.ib(default=3600)
+    lock = attr.ib(default=attr.Factory(threading.Lock), init=False, repr=False)
+
+    def _read(self):
+        try:
+            with open(self.path, "r") as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(data, dict):
+            return {}
+        return data
+
+    def _write(self, data):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temporary_path = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(temporary_path, "w") as fh:
+            json.dump(data, fh)
+        os.replace(temporary_path, self.path)
+
+    def get(self, url):
+        """
+        Returns the remembered API version for the host URL, or None if we
+        don't have a recent enough one.
+        """
+        if not self.ttl:
+            return None
+        with self.lock:
+            entry = self._read().get(url)
+        if not isinstance(entry, dict) or time.time() - entry.get("time", 0) > self.ttl:
+            return None
+        return entry.get("version")
+
+    def set(self, url, version):
+        if not self.ttl:
+            return
+        with self.lock:
+            data = self._read()
+            data[url] = {"version": version, "time": time.time()}
+            self._write(data)
+
+    def forget(self, url):
+        """
+        Drops the remembered API version for the host URL, if there is one.
+        """
+        with self.lock:
+            data = self._read()
+            if data.pop(url, None) is not None:
+                self._write(data)
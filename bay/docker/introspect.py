@@ -1,6 +1,9 @@
 import attr
+import json
+import threading
 from ..containers.formation import ContainerFormation, ContainerInstance
 from ..exceptions import DockerRuntimeError
+from ..utils.threading import parallel_map
 
 import warnings
 
@@ -17,6 +20,11 @@ class FormationIntrospector:
     network = attr.ib(default=None)
     formation = attr.ib(init=False)
 
+    # Label every bay-created container carries, naming its container in the graph
+    CONTAINER_LABEL = "com.eventbrite.bay.container"
+    # How many inspects to run at once for containers the list data isn't enough for
+    INSPECT_CONCURRENCY = 8
+
     class ContainerNotFound(DockerRuntimeError):
         pass
 
@@ -30,10 +38,23 @@ class FormationIntrospector:
         """
         # Make the formation
         self.formation = ContainerFormation(self.graph, self.network)
-        # Go through all containers on the remote host that are running and on the right network
-        for container in self.host.client.containers(all=False):
-            if self.network in container['NetworkSettings']['Networks']:
-                self.add_container(container['Names'][0].lstrip("/"))
+        # Ask the host for just the running bay containers on our network, in one request. The list data
+        # has everything we need for each one; only fall back to inspecting (in parallel) if it doesn't.
+        summaries = []
+        to_inspect = []
+        containers = self.host.client.containers(
+            all=False,
+            filters={"label": self.CONTAINER_LABEL, "network": self.network},
+        )
+        for details in containers:
+            summary = self._summary_from_list(details)
+            if summary is None:
+                to_inspect.append(details["Names"][0].lstrip("/"))
+            else:
+                summaries.append(summary)
+        summaries.extend(parallel_map(self._inspect_summary, to_inspect, size=self.INSPECT_CONCURRENCY))
+        for summary in summaries:
+            self.add_container(summary)
         # As a second phase, go through and resolve links
         for instance in self.formation:
             instance.resolve_links()
@@ -50,31 +71,82 @@ class FormationIntrospector:
 
         # A race condition in docker [2017/09] means it returns a different format for containers that have just died
         if isinstance(details[0], dict):
+            # The name filter matches substrings, so find the exact container if we can
+            for candidate in details:
+                if candidate["Names"][0].lstrip("/") == name:
+                    summary = self._summary_from_list(candidate)
+                    if summary is not None:
+                        return self._create_container(summary)
+                    break
             container_name = details[0]["Names"][0].lstrip("/")
         else:
             container_name = details[0]
 
-        return self._create_container(container_name)
+        return self._create_container(self._inspect_summary(container_name))
 
-    def add_container(self, container_details):
+    def add_container(self, summary):
         try:
-            instance = self._create_container(container_details)
+            instance = self._create_container(summary)
             self.formation.add_instance(instance)
         except self.ContainerNotFound as e:
             warnings.warn(e.args[0])
 
-    def _create_container(self, container_name):
+    def _summary_from_list(self, details):
         """
-        Returns a container build from introspected information
+        Pulls what we need out of a container's entry in the container list, or
+        returns None if it's missing something (e.g. from an older Docker).
+        """
+        network = (details.get("NetworkSettings") or {}).get("Networks", {}).get(self.network)
+        if network is None or "Mounts" not in details or not details.get("ImageID") or "Labels" not in details:
+            return None
+        # Containers using Docker links need them listed on the network entry
+        if (details["Labels"] or {}).get("com.eventbrite.bay.link-mode") != "aliases" and "Links" not in network:
+            return None
+        return {
+            "name": details["Names"][0].lstrip("/"),
+            "labels": details["Labels"] or {},
+            "image": details["ImageID"],
+            "network": network,
+            "mount_destinations": {mount["Destination"] for mount in details["Mounts"]},
+            "port_mapping": {
+                int(port["PrivatePort"]): int(port["PublicPort"])
+                for port in details.get("Ports") or []
+                if port.get("PublicPort")
+            },
+        }
+
+    def _inspect_summary(self, container_name):
+        """
+        Inspects a container and pulls out the same things as _summary_from_list.
         """
         assert isinstance(container_name, str)
-        container_details = self.host.client.inspect_container(container_name)
+        details = self.host.client.inspect_container(container_name)
+        port_mapping = {}
+        for container_port, host_details in details['NetworkSettings'].get('Ports', {}).items():
+            if host_details:
+                private_port = int(container_port.split("/", 1)[0])
+                public_port = int(host_details[0]['HostPort'])
+                port_mapping[private_port] = public_port
+        return {
+            "name": container_name,
+            "labels": details['Config']['Labels'] or {},
+            "image": details['Image'],
+            "network": details['NetworkSettings']['Networks'][self.network],
+            "mount_destinations": {mount['Destination'] for mount in details['Mounts']},
+            "port_mapping": port_mapping,
+        }
+
+    def _create_container(self, summary):
+        """
+        Returns a container build from introspected information
+        """
+        container_name = summary["name"]
+        labels = summary["labels"]
         # Find the container name in the graph
         try:
-            labels = container_details['Config']['Labels']
             # Use the bay-specific (not eventbrite-specific, just named uniquely as per the docker label spec) label
             # to work out what container name this was.
-            container = self.graph[labels['com.eventbrite.bay.container']]
+            container = self.graph[labels[self.CONTAINER_LABEL]]
         except KeyError:
             raise self.ContainerNotFound(
                 (
@@ -83,7 +155,7 @@ class FormationIntrospector:
                 ).format(container_name)
             )
         # Get the image hash
-        image = container_details['Image']
+        image = summary["image"]
         assert ":" in image
         if image.startswith("sha256:"):
             image_id = image
@@ -94,17 +166,27 @@ class FormationIntrospector:
             image_id = self.host.images.image_version(name, tag)
         # Work out links
         links = {}
-        for link in (container_details['NetworkSettings']['Networks'][self.network].get('Links', None) or []):
+        if labels.get('com.eventbrite.bay.link-mode') == "aliases":
+            # There are no Docker links to read, so reconstruct them from the graph; links are aliased by
+            # container name and instances are named predictably. Missing ones are dropped by resolve_links.
+            for dependency in self.graph.dependencies(container):
+                links[dependency.name] = "{}.{}.1".format(self.graph.prefix, dependency.name)
+        for link in (summary["network"].get('Links', None) or []):
             linked_container_name, link_alias = link.split(":", 1)
             links[link_alias] = linked_container_name
         # Work out devmodes
-        mounted_targets = set()
+        mounted_targets = summary["mount_destinations"]
         devmodes = set()
-        for mount in container_details['Mounts']:
-            mounted_targets.add(mount['Destination'])
         for devmode, mounts in container.devmodes.items():
             if all((destination in mounted_targets) for destination in mounts.keys()):
                 devmodes.add(devmode)
+        # Read the configuration fingerprint it was created with, if it has one
+        recorded_config = None
+        if "com.eventbrite.bay.config" in labels:
+            try:
+                recorded_config = json.loads(labels["com.eventbrite.bay.config"])
+            except ValueError:
+                pass
         # Make a formation instance
         instance = ContainerInstance(
             name=container_name,
@@ -112,13 +194,114 @@ class FormationIntrospector:
             image_id=image_id,
             links=links,
             devmodes=devmodes,
+            recorded_config=recorded_config,
         )
         # Set extra networking attributes because it's running
-        instance.ip_address = container_details['NetworkSettings']['Networks'][self.network]['IPAddress']
-        instance.port_mapping = {}
-        for container_port, host_details in container_details['NetworkSettings'].get('Ports', {}).items():
-            if host_details:
-                private_port = int(container_port.split("/", 1)[0])
-                public_port = int(host_details[0]['HostPort'])
-                instance.port_mapping[private_port] = public_port
+        instance.ip_address = summary["network"]['IPAddress']
+        instance.port_mapping = dict(summary["port_mapping"])
         return instance
+
+
+@attr.s
+class FormationSnapshot:
+    """
+    The formation running on a host, introspected once per command and then
+    kept up to date as containers are started and stopped, so plugins and
+    hooks can ask what's running without going back to Docker each time.
+
+    Anything that changes behind our back during the command (like a container
+    crashing) won't show up here, so code that is about to act on a specific
+    container should still check it directly.
+    """
+    host = attr.ib()
+    graph = attr.ib()
+    network = attr.ib(default=None)
+    formation = attr.ib(default=None, init=False, repr=False)
+    image_details = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    lock = attr.ib(default=attr.Factory(threading.RLock), init=False, repr=False)
+
+    def introspect(self):
+        """
+        Returns a copy of the running formation that is safe to modify,
+        introspecting the host if we haven't yet.
+        """
+        with self.lock:
+            copy = ContainerFormation(self.graph, self._load().network)
+            for instance in self.formation:
+                copy.add_instance(self._copy_instance(instance))
+        for instance in copy:
+            instance.resolve_links()
+        return copy
+
+    def is_running(self, container_name):
+        """
+        Returns True if an instance of the named container is running.
+        """
+        with self.lock:
+            return any(instance.container.name == container_name for instance in self._load())
+
+    def instance_started(self, instance):
+        """
+        Records that the (introspected) instance is now running.
+        """
+        with self.lock:
+            if self.formation is None:
+                return
+            self._discard(instance.name)
+            self.formation.add_instance(self._copy_instance(instance))
+
+    def instance_stopped(self, instance):
+        """
+        Records that the instance is no longer running.
+        """
+        with self.lock:
+            if self.formation is not None:
+                self._discard(instance.name)
+
+    def invalidate(self):
+        """
+        Forgets what's running, so the next question introspects the host again.
+        """
+        with self.lock:
+            self.formation = None
+
+    def inspect_image(self, image_id):
+        """
+        Returns the inspect details of an image by ID. As an ID always refers
+        to the same image, these are kept for the rest of the command.
+        """
+        with self.lock:
+            details = self.image_details.get(image_id)
+        if details is None:
+            details = self.host.client.inspect_image(image_id)
+            with self.lock:
+                self.image_details[image_id] = details
+        return details
+
+    def _load(self):
+        if self.formation is None:
+            self.formation = FormationIntrospector(self.host, self.graph, self.network).introspect()
+        return self.formation
+
+    def _discard(self, name):
+        instance = self.formation.container_instances.pop(name, None)
+        if instance is not None:
+            instance.formation = None
+
+    @staticmethod
+    def _copy_instance(instance):
+        """
+        Clones an instance with its links turned back into names, so they
+        resolve against whichever formation the clone ends up in.
+        """
+        copy = instance.clone()
+        copy.devmodes = set(instance.devmodes)
+        copy.ports = dict(instance.ports)
+        copy.environment = dict(instance.environment)
+        copy.links = {
+            alias: target if isinstance(target, str) else target.name
+            for alias, target in instance.links.items()
+        }
+        copy.ip_address = instance.ip_address
+        copy.port_mapping = dict(instance.port_mapping)
+        return copy
@@ -0,0 +1,59 @@
+import calendar
+import time
+
+
+def parse_timestamp(value):
+    """
+    Turns a Docker RFC 3339 timestamp (like "2017-09-01T12:34:56.123456789Z")
+    into a (seconds since the epoch, nanoseconds) tuple, which compares
+    correctly at full precision. Raises ValueError if it can't be parsed.
+    """
+    if not value.endswith("Z"):
+        raise ValueError("Timestamp {!r} is not in UTC".format(value))
+    date, _, fraction = value[:-1].partition(".")
+    seconds = calendar.timegm(time.strptime(date, "%Y-%m-%dT%H:%M:%S"))
+    if fraction and not fraction.isdigit():
+        raise ValueError("Invalid fractional seconds in timestamp {!r}".format(value))
+    return (seconds, int((fraction + "000000000")[:9]))
+
+
+def container_started_at(host, container_name):
+    """
+    Returns when the container was last started, by the host's clock, as a
+    (seconds, nanoseconds) tuple.
+    """
+    return parse_timestamp(host.client.inspect_container(container_name)["State"]["StartedAt"])
+
+
+def follow_output(host, container_name):
+    """
+    Yields each line of the container's output (as bytes) as it's produced.
+
+    Only output from its latest start is included, so a stopped container
+    that's started again doesn't replay what it printed last time.
+    """
+    started = container_started_at(host, container_name)
+    stream = host.client.logs(
+        container_name,
+        stream=True,
+        follow=True,
+        timestamps=True,
+        # Only whole seconds can be asked for, so the timestamps weed out the rest
+        since=max(started[0], 1),
+    )
+    buffer = b""
+    try:
+        for chunk in stream:
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                timestamp, _, text = line.partition(b" ")
+                try:
+                    if parse_timestamp(timestamp.decode("ascii")) < started:
+                        continue
+                except (UnicodeDecodeError, ValueError):
+                    pass
+                yield text
+    finally:
+        if hasattr(stream, "close"):
+            stream.close()
@@ -0,0 +1,75 @@
+import attr
+
+
+@attr.s
+class FormationPlan:
+    """
+    The set of changes needed to turn a current formation into a desired one.
+
+    :added: Instances that are not running and need starting
+    :removed: Instances that are running and need stopping
+    :restarted: A dict of {instance: [changed field names]} for instances that
+                are running but need stopping and starting again
+    """
+    added = attr.ib(default=attr.Factory(set))
+    removed = attr.ib(default=attr.Factory(set))
+    restarted = attr.ib(default=attr.Factory(dict))
+
+    @classmethod
+    def from_formations(cls, current, desired, force_restart=()):
+        """
+        Diffs the two formations. Any instance names in force_restart are
+        treated as changed even if their configuration is identical.
+        """
+        plan = cls()
+        for instance in current:
+            if instance not in desired:
+                plan.removed.add(instance)
+        for instance in desired:
+            if instance not in current:
+                plan.added.add(instance)
+            else:
+                # It's in both - stop and start if it's changed
+                changes = instance.differences(current[instance.name])
+                if not changes and instance.name in force_restart:
+                    changes = ["restart requested"]
+                if changes:
+                    plan.restarted[instance] = changes
+        return plan
+
+    @property
+    def to_stop(self):
+        return self.removed | set(self.restarted)
+
+    @property
+    def to_start(self):
+        return self.added | set(self.restarted)
+
+    @property
+    def empty(self):
+        return not (self.added or self.removed or self.restarted)
+
+    def start_waves(self):
+        """
+        Returns the instances to start grouped into dependency waves: each
+        wave only depends on instances in earlier waves (or already running).
+        """
+        to_start = self.to_start
+        waves = []
+        placed = set()
+        while len(placed) < len(to_start):
+            wave = {
+                instance
+                for instance in to_start - placed
+                if all(
+                    (dependency in placed or dependency not in to_start)
+                    for dependency in instance.links.values()
+                )
+            }
+            if not wave:
+                raise ValueError("Circular dependency detected between: {}".format(
+                    ", ".join(sorted(i.name for i in to_start - placed)),
+                ))
+            waves.append(wave)
+            placed.update(wave)
+        return waves
@@ -1,25 +1,33 @@
+import attr
 import dockerpty
-import functools
+import json
 import os
+import queue
 import sys
-import threading
 import time
 
-from docker.errors import NotFound
+from docker.errors import APIError, NotFound
+from docker.types import IPAMConfig, IPAMPool
 
+from .history import BootHistory, StopHistory
+from .events import HostStateMirror
 from .introspect import FormationIntrospector
+from .plan import FormationPlan
 from .towline import Towline
 from ..cli.tasks import Task
 from ..constants import PluginHook
-from ..exceptions import ContainerBootFailure, DockerRuntimeError, DockerInteractiveException, NotFoundException
-from ..utils.sorting import dependency_sort
-from ..utils.threading import ExceptionalThread, ThreadSet
+from ..exceptions import (
+    ContainerBootFailure, DockerRuntimeError, DockerInteractiveException, NotFoundException, PartialRunFailure,
+)
+from ..utils.sorting import critical_path_weights, dependency_levels
+from ..utils.threading import AdaptiveLimiter, ThreadSet, WorkerPool
 
 
-network_lock = threading.Lock()
-
 # Tracks which containers are being started/stopped globally to avoid starting the same one twice.
 changing_containers = ThreadSet()
+# Results left on changing_containers for anyone waiting on the same container
+STARTED = "started"
+STOPPED = "stopped"
 
 
 class FormationRunner:
@@ -30,94 +38,149 @@ class FormationRunner:
     It can run actions in parallel in background threads if needs be.
     """
 
-    def __init__(self, app, host, formation, task, stop=True):
+    # How many of a container's recent stops must have hit the stop timeout for us to mention it
+    STOP_TIMEOUT_REPORT_THRESHOLD = 2
+
+    def __init__(self, app, host, formation, task, stop=True, keep_going=False, fast_stop=False):
         self.app = app
         self.host = host
         self.formation = formation
-        self.introspector = FormationIntrospector(self.host, self.formation.graph)
+        # What's running on the host, shared with the rest of the command and updated as we go
+        self.snapshot = self.app.formation_snapshot(self.host)
         self.task = task
         # Allows things to override and not have anything stop
         self.stop = stop
+        # If a failure should only skip what depends on the failed instance, rather than stopping everything
+        self.keep_going = keep_going
+        # If containers should be killed straight away, a dependency level at a time, rather than stopped gracefully
+        self.fast_stop = fast_stop
+        # Upper bound on how many containers are started/stopped at once
+        self.max_workers = self.app.config["bay"]["max_workers"]
+        # How many (weighted) containers may boot at once; adapts to host load and Docker API latency
+        self.boot_limiter = AdaptiveLimiter(
+            initial=min(self.max_workers, os.cpu_count() or 4),
+            maximum=self.max_workers,
+        )
+        # Past boot durations, used to start the slowest chains first
+        self.boot_history = BootHistory.for_app(self.app)
+        # Whether each container's recent graceful stops ran out of time and it was killed
+        self.stop_history = StopHistory.for_app(self.app)
+        # {instance: priority} for the containers being started, slowest chains highest
+        self.launch_priorities = {}
+        # Instances whose containers are created and waiting for their dependencies before being started
+        self.prepared_containers = {}
+        # If we've made sure the formation network exists
+        self.network_ready = False
+
+    def plan(self, force_restart=()):
+        """
+        Works out what containers need turning off, and which need turning on,
+        without changing anything. Containers that have changes will need both.
+        Returns a FormationPlan.
+        """
+        # Check the formation is valid
+        self.formation.validate()
+        return FormationPlan.from_formations(
+            self.snapshot.introspect(),
+            self.formation,
+            force_restart=force_restart,
+        )
 
     def run(self):
         """
         Runs through and performs all the actions. Blocks until completion.
         """
         self.actions = []
-        # Check the formation is valid
-        self.formation.validate()
-        # Work out what containers need turning off, and which need turning on
-        # Containers that have changes will need both.
-        to_stop = set()
-        to_start = set()
-        current_formation = self.introspector.introspect()
-        for instance in current_formation:
-            if instance not in self.formation:
-                to_stop.add(instance)
-        # Now see if there are any that are entirely new
-        for instance in self.formation:
-            if instance not in current_formation:
-                to_start.add(instance)
-            else:
-                # It's in both - stop and start if it's changed
-                if instance.different_from(current_formation[instance.name]):
-                    to_stop.add(instance)
-                    to_start.add(instance)
+        plan = self.plan()
         # Stop containers in parallel
-        if to_stop and self.stop:
-            self.stop_containers(to_stop)
+        if plan.to_stop and self.stop:
+            self.stop_containers(plan.to_stop)
         # Start containers in parallel
-        if to_start:
-            self.start_containers(to_start)
+        if plan.to_start:
+            self.start_containers(plan.to_start)
 
     # Shared "dependency-based parallel execution" code
 
-    def parallel_execute(self, instances, ready_to_execute, executor, done=None):
-        """
-        Runs the "executor" in parallel threads on "instances" when the condition
-        "ready_to_execute" is met for an instance. Handles deadlocking as well.
-        """
-        idle_iterations = 0
-        queued = set(instances)
-        processing = set()
-        done = done or set()
-        threads = {}
-        while queued or processing:
-            # See if we can stop anything new - everything that depends on it must also be stopped
-            for instance in list(queued):
-                if ready_to_execute(instance, done):
-                    threads[instance] = ExceptionalThread(
-                        target=executor,
-                        args=(instance,),
-                        daemon=True,
-                    )
-                    threads[instance].start()
-                    queued.remove(instance)
-                    processing.add(instance)
-                    idle_iterations = 0
-            # See if anything finished stopping
-            for instance in list(processing):
-                if not threads[instance].is_alive():
-                    processing.remove(instance)
-                    done.add(instance)
-                    # Collect exceptions from the thread - if it's an interactive exception, run the rest of it.
-                    try:
-                        threads[instance].maybe_raise()
-                    except DockerInteractiveException as e:
-                        e.handler()
+    def parallel_execute(self, instances, ready_to_execute, executor, done=None, priorities=None):
+        """
+        Runs the "executor" on "instances" in a bounded pool of worker threads,
+        dispatching each instance as soon as the condition "ready_to_execute" is
+        met for it (re-checked every time another instance finishes).
+        If "priorities" ({instance: number}) is given, higher values get free
+        workers first. Handles deadlocking as well.
+        """
+        self.staged_execute(
+            instances,
+            [(lambda instance, done_by_stage: ready_to_execute(instance, done_by_stage[0]), executor)],
+            done=done,
+            priorities=priorities,
+        )
+
+    def staged_execute(self, instances, stages, done=None, priorities=None):
+        """
+        Runs "instances" through a pipeline of stages, each a
+        (ready_to_execute, executor) pair with its own bounded pool of worker
+        threads. An instance enters a stage once it has finished the previous
+        one and ready_to_execute(instance, done_by_stage) is met, where
+        done_by_stage is a list of the sets of instances that have finished
+        each stage. Instances in "done" count as having finished every stage.
+
+        In keep-going mode a failed instance never counts as done, so only the
+        instances waiting on it are held back; everything else carries on and
+        a PartialRunFailure is raised at the end.
+        """
+        done_by_stage = [set(done or ()) for _ in stages]
+        queued = [set(instances)] + [set() for _ in stages[1:]]
+        processing = [set() for _ in stages]
+        priorities = priorities or {}
+        failures = {}
+        completed = queue.Queue()
+        pools = [WorkerPool(self.max_workers, completed=completed) for _ in stages]
+        try:
+            while True:
+                # Dispatch everything that is now unblocked
+                for index, (ready_to_execute, executor) in enumerate(stages):
+                    for instance in list(queued[index]):
+                        if ready_to_execute(instance, done_by_stage):
+                            pools[index].submit(
+                                (index, instance),
+                                executor,
+                                instance,
+                                priority=priorities.get(instance, 0),
+                            )
+                            queued[index].remove(instance)
+                            processing[index].add(instance)
+                if not any(processing):
+                    break
+                # Block until something finishes - that's the only thing that can unblock more work
+                (index, instance), exception = completed.get()
+                processing[index].remove(instance)
+                # Collect exceptions from the worker - if it's an interactive exception, run the rest of it.
+                if exception is not None:
+                    if isinstance(exception, DockerInteractiveException):
+                        exception.handler()
                         sys.exit(0)
-                    del threads[instance]
-                    idle_iterations = 0
-            # If there's nothing in progress, we've deadlocked
-            if idle_iterations > 10 and queued and not processing:
-                raise DockerRuntimeError(
-                    "Deadlock during stop: Cannot stop any of {}.".format(
-                        ", ".join(i.name for i in queued),
-                    ),
-                )
-            idle_iterations += 1
-            # Don't idle hot
-            time.sleep(0.1)
+                    if self.keep_going and isinstance(exception, Exception):
+                        failures[instance] = exception
+                        continue
+                    raise exception
+                done_by_stage[index].add(instance)
+                if index + 1 < len(stages):
+                    queued[index + 1].add(instance)
+        finally:
+            for pool in pools:
+                pool.shutdown()
+        stuck = set().union(*queued)
+        # Anything left is waiting on a failure
+        if failures:
+            raise PartialRunFailure(failures, skipped=stuck)
+        # If there's nothing in progress but still things queued, we've deadlocked
+        if stuck:
+            raise DockerRuntimeError(
+                "Deadlock: Cannot run any of {}.".format(
+                    ", ".join(i.name for i in stuck),
+                ),
+            )
 
     # Stopping
 
@@ -125,32 +188,43 @@ class FormationRunner:
         """
         Stops all the specified containers in parallel, still respecting links
         """
-        current_formation = self.introspector.introspect()
+        # Follow the host's events so checking on containers doesn't need a round-trip each time
+        self.host.state_mirror.start()
+        # Index who links to what once, so sorting and readiness checks are just lookups
+        incoming_links = self.snapshot.introspect().reverse_links()
 
-        # Inner function that we can pass to dependency_sort
-        @functools.lru_cache(maxsize=512)
         def get_incoming_links(instance):
-            result = set()
-            for potential_linker in current_formation:
-                links_to = potential_linker.links.values()
-                if instance in links_to:
-                    result.add(potential_linker)
-            return result
-
-        # Resolve container list to include descendency
-        instances = dependency_sort(instances, get_incoming_links)
-        # Parallel-stop things
-        self.parallel_execute(
-            instances,
-            lambda instance, done: all((linker in done) for linker in get_incoming_links(instance)),
-            executor=self.stop_container,
-        )
+            return incoming_links.get(instance, ())
+
+        # Resolve container list to include descendency, grouped so each level only links to earlier ones
+        levels = dependency_levels(instances, get_incoming_links)
+        instances = [instance for level in levels for instance in level]
+        try:
+            if self.fast_stop:
+                # Kill each level of dependents as one wave; there's no grace period to wait on
+                for wave in levels:
+                    self.parallel_execute(wave, lambda instance, done: True, executor=self.stop_container)
+            else:
+                # Parallel-stop things
+                self.parallel_execute(
+                    instances,
+                    lambda instance, done: all((linker in done) for linker in get_incoming_links(instance)),
+                    executor=self.stop_container,
+                )
+        finally:
+            self.report_stop_timeouts(instances)
+            self.stop_history.save()
 
     def stop_container(self, instance):
         # Wait for the global container manipulation lock
-        with changing_containers.entry_lock(instance.name):
-            # See if it was already stopped
-            if not self.host.container_running(instance.name, ignore_exists=True):
+        with changing_containers.entry_lock(instance.name) as lock_outcome:
+            # See if it was already stopped (by whoever we were waiting on, or otherwise)
+            if lock_outcome["previous"] == STOPPED or not self.host.container_running(
+                instance.name,
+                ignore_exists=True,
+            ):
+                self.snapshot.instance_stopped(instance)
+                lock_outcome["result"] = STOPPED
                 return
             # Stop the container
             stop_task = Task(
@@ -158,11 +232,39 @@ class FormationRunner:
                 parent=self.task,
                 collapse_if_finished=True,
             )
+            stop_timeout = 0 if self.fast_stop else instance.container.stop_timeout
+            stop_start = time.time()
             self.host.client.stop(
                 instance.name,
-                timeout=0 if instance.container.fast_kill else 10,
+                timeout=stop_timeout,
+            )
+            self.host.state_mirror.record(instance.name, HostStateMirror.STOPPED)
+            # If it took the whole timeout, it didn't exit on its own and got killed
+            if stop_timeout and time.time() - stop_start >= stop_timeout:
+                self.stop_history.record(instance.container.name, killed=True)
+                stop_task.finish(status="Killed after {}s".format(stop_timeout), status_flavor=Task.FLAVOR_WARNING)
+            else:
+                if stop_timeout:
+                    self.stop_history.record(instance.container.name, killed=False)
+                stop_task.finish(status="Done", status_flavor=Task.FLAVOR_GOOD)
+            self.snapshot.instance_stopped(instance)
+            lock_outcome["result"] = STOPPED
+
+    def report_stop_timeouts(self, instances):
+        """
+        Points out containers that keep having to be killed when they're stopped,
+        as they slow down every restart.
+        """
+        slow = [
+            instance.container.name
+            for instance in instances
+            if self.stop_history.keeps_getting_killed(instance.container.name, self.STOP_TIMEOUT_REPORT_THRESHOLD)
+        ]
+        if slow:
+            self.task.add_extra_info(
+                "These containers keep hitting their stop timeout: {}. Consider setting stop_signal, "
+                "or init: true, in their bay.yaml.".format(", ".join(sorted(slow)))
             )
-            stop_task.finish(status="Done", status_flavor=Task.FLAVOR_GOOD)
 
     # Starting
 
@@ -170,37 +272,262 @@ class FormationRunner:
         """
         Starts all the specified containers in parallel, respecting links
         """
-        current_formation = self.introspector.introspect()
-        self.parallel_execute(
+        current_formation = self.snapshot.introspect()
+        if self.formation.graph.link_mode == "aliases":
+            # Nothing is linked at create time, so everything can be created straight away
+            ready_to_prepare = lambda instance, done_by_stage: True
+        else:
+            # Legacy links need their targets to exist when the container is created
+            ready_to_prepare = lambda instance, done_by_stage: all(
+                (dependency in done_by_stage[0]) for dependency in instance.links.values()
+            )
+        # The slowest chains go first, both for workers and for boot capacity
+        self.launch_priorities = self.boot_priorities(instances)
+        # Every container goes on the formation network, so make sure it's there before starting any
+        self.ensure_network()
+        self.host.state_mirror.start()
+        try:
+            self.staged_execute(
+                instances,
+                [
+                    (ready_to_prepare, self.prepare_container),
+                    (self.ready_to_launch, self.launch_container),
+                    # Waits always gate the formation being ready, as we don't return until this stage is done
+                    (lambda instance, done_by_stage: True, self.await_container_boot),
+                ],
+                done=set(started_instance for started_instance in current_formation),
+                priorities=self.launch_priorities,
+            )
+        finally:
+            # Anything that was prepared but never finished booting still holds its lock
+            for instance in list(self.prepared_containers):
+                self.release_prepared(instance)
+            self.boot_history.save()
+
+    def ensure_network(self):
+        """
+        Creates the formation network if it doesn't exist yet, using the
+        network options from the top-level bay.yaml. Only checks once per run.
+        """
+        if self.network_ready:
+            return
+        network = self.formation.network
+        try:
+            self.host.client.inspect_network(network)
+        except NotFound:
+            options = self.formation.graph.network_options
+            driver_options = {}
+            if options.get("mtu"):
+                driver_options["com.docker.network.driver.mtu"] = str(options["mtu"])
+            ipam = None
+            if options.get("subnet"):
+                ipam = IPAMConfig(pool_configs=[IPAMPool(subnet=options["subnet"], gateway=options.get("gateway"))])
+            try:
+                self.host.client.create_network(
+                    name=network,
+                    driver=options["driver"],
+                    options=driver_options or None,
+                    ipam=ipam,
+                )
+            except APIError as error:
+                # Someone else (e.g. another bay run) may have made it in the meantime; if not, the
+                # create itself failed (e.g. a bad or overlapping subnet), so report that
+                try:
+                    self.host.client.inspect_network(network)
+                except NotFound:
+                    raise error from None
+        self.network_ready = True
+
+    @staticmethod
+    def ready_to_launch(instance, done_by_stage):
+        """
+        Says if an instance can be started: each link target must have
+        finished booting, or just be running if the link allows early start.
+        """
+        for alias, dependency in instance.links.items():
+            if instance.container.link_starts_early(alias):
+                if dependency not in done_by_stage[1]:
+                    return False
+            elif dependency not in done_by_stage[2]:
+                return False
+        return True
+
+    def boot_priorities(self, instances):
+        """
+        Returns {instance: seconds} giving the expected time from starting
+        each instance to the end of the longest dependency chain behind it,
+        based on recorded boot times. Starting the highest values first keeps
+        the critical path moving when worker slots are limited.
+        """
+        instances = set(instances)
+        dependents = {instance: set() for instance in instances}
+        for instance in instances:
+            for dependency in instance.links.values():
+                if dependency in dependents:
+                    dependents[dependency].add(instance)
+        return critical_path_weights(
             instances,
-            lambda instance, done: all((dependency in done) for dependency in instance.links.values()),
-            executor=self.start_container,
-            done=set(started_instance for started_instance in current_formation),
+            lambda instance: dependents[instance],
+            lambda instance: self.boot_history.estimate(instance.container.name),
         )
 
-    def remove_stopped(self, instance):
+    def estimate_start_duration(self, instances):
+        """
+        Returns the expected number of seconds to start the given instances,
+        based on recorded boot times along the longest dependency chain.
+        """
+        return max(self.boot_priorities(instances).values(), default=0)
+
+    def remove_stopped(self, instance, config_digests=None):
         """
         Sees if there is a container with the same name and removes it if
         there is and it's stopped.
+
+        If config_digests is given and the stopped container was created with
+        that same configuration, and the same runtime extras from plugins (so
+        the pre-run hooks must have run already), it is kept rather than
+        removed and True is returned, so it can just be started again.
         """
-        if self.host.container_exists(instance.name):
-            if self.host.container_running(instance.name):
-                raise DockerRuntimeError("The container {} is already running.".format(instance.container.name))
-            else:
-                self.host.client.remove_container(instance.name)
+        try:
+            details = self.host.client.inspect_container(instance.name)
+        except NotFound:
+            return False
+        if details['State']['Running']:
+            raise DockerRuntimeError("The container {} is already running.".format(instance.container.name))
+        labels = details['Config'].get('Labels') or {}
+        if (
+            config_digests is not None and
+            not instance.foreground and
+            labels.get("com.eventbrite.bay.config-hash") == instance.config_hash(config_digests) and
+            labels.get("com.eventbrite.bay.runtime-hash") == self.runtime_hash(instance)
+        ):
+            return True
+        self.host.client.remove_container(instance.name)
+        self.host.state_mirror.record(instance.name, HostStateMirror.MISSING)
+        return False
+
+    @staticmethod
+    def runtime_hash(instance):
+        """
+        Returns a hash of the instance's configuration as it will actually be
+        run, including what plugins add to it (like the ssh-agent or legacy
+        link environment variables).
+        """
+        return instance.config_hash(instance.config_digests())
 
-    def start_container(self, instance):
+    def create_container(self, instance, config_digests):
         """
-        Creates the Docker container on the host, ready to be started.
+        Creates the Docker container for the instance, ready to be started,
+        labelled with its configuration fingerprint. Returns the container
+        pointer.
+        """
+        # Create network configuration for the new container. In aliases mode, the container registers
+        # its own name as a network alias so others can reach it without links (links are always
+        # aliased by container name), and so it does not need its link targets to exist yet.
+        link_mode = instance.formation.graph.link_mode
+        if link_mode == "aliases":
+            endpoint_config = self.host.client.create_endpoint_config(
+                aliases=[instance.formation.network, instance.container.name],
+            )
+        else:
+            endpoint_config = self.host.client.create_endpoint_config(
+                aliases=[instance.formation.network],
+                links=[
+                    (link.name, alias)
+                    for alias, link in instance.links.items()
+                ]
+            )
+        networking_config = self.host.client.create_networking_config({
+            instance.formation.network: endpoint_config,
+        })
+
+        # Work out volumes configuration
+        # Docker's `binds` argument (defined here as `volume_binds`) can be in two formats. It can be in a list of
+        # strings `'{source}:{destination}:{mode}'`, or it can be a dict whose keys are sources and whose values
+        # are a dict of `{'bind': '{destination}', 'mode': '{mode}'}`. If you specify `binds` in dict format,
+        # the Docker SDK converts it to list format before sending it to the Docker process. However, the dict
+        # format limits you to one container mountpoint per host source. Docker permits multiple container
+        # mountpoints per host source, and the only way to specify that is with the list format. Previously we used
+        # the dict format here, but now we use the list format to support multiple mountpoints.
+        volume_mountpoints = []
+        volume_binds = []
+
+        def add_volume_mount(mount_path, volume):
+            if self.host.supports_cached_volumes and ",cached" not in volume.mode:
+                volume.mode = volume.mode + ",cached"
+            volume_mountpoints.append(mount_path)
+            volume_binds.append('{}:{}:{}'.format(volume.source, mount_path, volume.mode))
+
+        for mount_path, volume in instance.container.bound_volumes.items():
+            if os.path.isdir(volume.source) or os.path.isfile(volume.source) or os.environ.get("BAY_VOLUME_HOME"):
+                add_volume_mount(mount_path, volume)
+            elif volume.required:
+                raise NotFoundException(
+                    "Volume mount source directory {} does not exist".format(volume.source)
+                )
+        # Add any active devmodes
+        for mount_name in instance.devmodes:
+            for mount_path, volume in instance.container.devmodes[mount_name].items():
+                if os.path.isdir(volume.source) or os.environ.get("BAY_VOLUME_HOME"):
+                    add_volume_mount(mount_path, volume)
+                else:
+                    raise NotFoundException(
+                        "Devmode source directory {} does not exist".format(volume.source)
+                    )
+        for mount_path, volume in instance.container.named_volumes.items():
+            add_volume_mount(mount_path, volume)
+
+        # Create container
+        container_pointer = self.host.client.create_container(
+            instance.image_id,
+            command=instance.command,
+            detach=not instance.foreground,
+            stdin_open=instance.foreground,
+            tty=instance.foreground,
+            # Ports is a list of ports in the container to expose
+            ports=list(instance.ports.keys()),
+            environment=instance.environment,
+            volumes=volume_mountpoints,
+            name=instance.name,
+            stop_signal=instance.container.stop_signal,
+            host_config=self.host.client.create_host_config(
+                init=True if instance.container.init else None,
+                mem_limit=instance.mem_limit,
+                binds=volume_binds,
+                port_bindings=instance.ports,
+                publish_all_ports=True,
+                security_opt=['seccomp:unconfined'],
+                cap_add=["SYS_PTRACE"],
+            ),
+            networking_config=networking_config,
+            labels={
+                "com.eventbrite.bay.container": instance.container.name,
+                "com.eventbrite.bay.link-mode": link_mode,
+                "com.eventbrite.bay.config": json.dumps(config_digests, sort_keys=True),
+                "com.eventbrite.bay.config-hash": instance.config_hash(config_digests),
+                "com.eventbrite.bay.runtime-hash": self.runtime_hash(instance),
+            }
+        )
+        self.host.state_mirror.record(instance.name, HostStateMirror.STOPPED)
+        return container_pointer
+
+    def prepare_container(self, instance):
+        """
+        First stage of starting: takes the container manipulation lock, runs
+        the pre-run plugins and creates the container (or finds a reusable
+        stopped one), ready to be started. None of this needs the instance's
+        dependencies to have booted, only to exist.
         """
         # Make sure it's not an abstract container being started.
         if instance.container.abstract and not instance.foreground:
             raise ValueError("You cannot boot an abstract container.")
 
-        # Wait for the global container manipulation lock
-        with changing_containers.entry_lock(instance.name):
-            # See if the container was already started
-            if self.host.container_running(instance.name, ignore_exists=True):
+        # Wait for the global container manipulation lock; release_prepared releases it once booting is over
+        previous = changing_containers.acquire(instance.name)
+        try:
+            # See if the container was already started (by whoever we were waiting on, or otherwise)
+            if previous == STARTED or self.host.container_running(instance.name, ignore_exists=True):
+                changing_containers.release(instance.name, STARTED)
                 return
 
             start_task = Task(
@@ -209,120 +536,120 @@ class FormationRunner:
                 collapse_if_finished=True,
             )
 
-            self.remove_stopped(instance)
+            # Fingerprint the desired configuration before plugins add their runtime extras to it,
+            # so the next run can tell if anything changed by comparing hashes
+            config_digests = instance.config_digests()
 
             # Run plugins
             self.app.run_hooks(PluginHook.PRE_RUN_CONTAINER, host=self.host, instance=instance, task=start_task)
 
-            # See if network exists and if not, create it
-            with network_lock:
-                try:
-                    self.host.client.inspect_network(instance.formation.network)
-                except NotFound:
-                    self.host.client.create_network(
-                        name=instance.formation.network,
-                        driver="bridge",
-                    )
-
-            # Create network configuration for the new container
-            networking_config = self.host.client.create_networking_config({
-                instance.formation.network: self.host.client.create_endpoint_config(
-                    aliases=[instance.formation.network],
-                    links=[
-                        (link.name, alias)
-                        for alias, link in instance.links.items()
-                    ]
-                ),
-            })
-
-            # Work out volumes configuration
-            # Docker's `binds` argument (defined here as `volume_binds`) can be in two formats. It can be in a list of
-            # strings `'{source}:{destination}:{mode}'`, or it can be a dict whose keys are sources and whose values
-            # are a dict of `{'bind': '{destination}', 'mode': '{mode}'}`. If you specify `binds` in dict format,
-            # the Docker SDK converts it to list format before sending it to the Docker process. However, the dict
-            # format limits you to one container mountpoint per host source. Docker permits multiple container
-            # mountpoints per host source, and the only way to specify that is with the list format. Previously we used
-            # the dict format here, but now we use the list format to support multiple mountpoints.
-            volume_mountpoints = []
-            volume_binds = []
-
-            def add_volume_mount(mount_path, volume):
-                if self.host.supports_cached_volumes and ",cached" not in volume.mode:
-                    volume.mode = volume.mode + ",cached"
-                volume_mountpoints.append(mount_path)
-                volume_binds.append('{}:{}:{}'.format(volume.source, mount_path, volume.mode))
-
-            for mount_path, volume in instance.container.bound_volumes.items():
-                if os.path.isdir(volume.source) or os.path.isfile(volume.source) or os.environ.get("BAY_VOLUME_HOME"):
-                    add_volume_mount(mount_path, volume)
-                elif volume.required:
-                    raise NotFoundException(
-                        "Volume mount source directory {} does not exist".format(volume.source)
-                    )
-            # Add any active devmodes
-            for mount_name in instance.devmodes:
-                for mount_path, volume in instance.container.devmodes[mount_name].items():
-                    if os.path.isdir(volume.source) or os.environ.get("BAY_VOLUME_HOME"):
-                        add_volume_mount(mount_path, volume)
-                    else:
-                        raise NotFoundException(
-                            "Devmode source directory {} does not exist".format(volume.source)
-                        )
-            for mount_path, volume in instance.container.named_volumes.items():
-                add_volume_mount(mount_path, volume)
+            # Stopped containers with an unchanged configuration (including what the plugins just added)
+            # are started again rather than recreated
+            reuse_stopped = self.remove_stopped(instance, config_digests)
 
-            # Create container
-            container_pointer = self.host.client.create_container(
-                instance.image_id,
-                command=instance.command,
-                detach=not instance.foreground,
-                stdin_open=instance.foreground,
-                tty=instance.foreground,
-                # Ports is a list of ports in the container to expose
-                ports=list(instance.ports.keys()),
-                environment=instance.environment,
-                volumes=volume_mountpoints,
-                name=instance.name,
-                host_config=self.host.client.create_host_config(
-                    mem_limit=instance.mem_limit,
-                    binds=volume_binds,
-                    port_bindings=instance.ports,
-                    publish_all_ports=True,
-                    security_opt=['seccomp:unconfined'],
-                    cap_add=["SYS_PTRACE"],
-                ),
-                networking_config=networking_config,
-                labels={
-                    "com.eventbrite.bay.container": instance.container.name,
-                }
+            create_start = time.time()
+            if reuse_stopped:
+                container_pointer = instance.name
+                start_task.update(status="Reusing stopped container")
+            else:
+                container_pointer = self.create_container(instance, config_digests)
+                self.boot_limiter.record_latency(time.time() - create_start, "create")
+                start_task.update(status="Created")
+            self.prepared_containers[instance] = PreparedContainer(
+                instance=instance,
+                task=start_task,
+                container_pointer=container_pointer,
+                config_digests=config_digests,
+                reused=reuse_stopped,
+                create_duration=time.time() - create_start,
             )
-            try:
-                # Foreground containers launch into a PTY at this point. We use an exception so that
-                # it happens in the main thread.
-                if instance.foreground:
-                    def handler():
-                        dockerpty.start(self.host.client, container_pointer)
-                        self.host.client.remove_container(container_pointer)
-                    start_task.finish(status="Going to shell", status_flavor=Task.FLAVOR_GOOD)
-                    raise DockerInteractiveException(handler)
+        except BaseException:
+            changing_containers.release(instance.name)
+            raise
 
-                else:
-                    # Make a towline instance and wait on it
-                    self.host.client.start(container_pointer)
-                    towline = Towline(self.host, instance.name)
-                    while True:
-                        status, message = towline.status
-                        if status is None:
-                            if message is not None:
-                                start_task.update(status=message)
-                        elif status is True:
-                            break
-                        elif status is False:
-                            raise ContainerBootFailure(
-                                "Failed during towline",
-                                instance=instance,
-                            )
-                        time.sleep(0.5)
+    def launch_container(self, instance):
+        """
+        Second stage of starting: waits for boot capacity and starts a
+        prepared container.
+        """
+        prepared = self.prepared_containers.get(instance)
+        # Nothing to do if it turned out to be running already
+        if prepared is None:
+            return
+        instance = prepared.instance
+        start_task = prepared.task
+        try:
+            # Foreground containers are interactive, so they don't count against boot capacity
+            if not instance.foreground:
+                start_task.update(status="Waiting for boot capacity")
+                self.boot_limiter.acquire(
+                    instance.container.boot_weight,
+                    priority=self.launch_priorities.get(instance, 0),
+                )
+                prepared.boot_weight = instance.container.boot_weight
+            prepared.boot_start = time.time()
+            # Foreground containers launch into a PTY at this point. We use an exception so that
+            # it happens in the main thread.
+            if instance.foreground:
+                def handler():
+                    dockerpty.start(self.host.client, prepared.container_pointer)
+                    self.host.client.remove_container(prepared.container_pointer)
+                start_task.finish(status="Going to shell", status_flavor=Task.FLAVOR_GOOD)
+                raise DockerInteractiveException(handler)
+            try:
+                self.host.client.start(prepared.container_pointer)
+                self.boot_limiter.record_latency(time.time() - prepared.boot_start, "start")
+            except APIError:
+                if not prepared.reused:
+                    raise
+                # The stopped container can't come back as-is (e.g. its network was recreated), so rebuild it
+                self.host.client.remove_container(prepared.container_pointer)
+                prepared.container_pointer = self.create_container(instance, prepared.config_digests)
+                self.host.client.start(prepared.container_pointer)
+            self.host.state_mirror.record(instance.name, HostStateMirror.RUNNING)
+            start_task.update(status="Running")
+        except BaseException:
+            self.release_prepared(instance)
+            raise
+
+    def await_container_boot(self, instance):
+        """
+        Third stage of starting: waits for a started container to finish
+        booting, running the post-run plugins (including waits).
+        """
+        prepared = self.prepared_containers.get(instance)
+        # Nothing to do if it turned out to be running already
+        if prepared is None:
+            return
+        instance = prepared.instance
+        start_task = prepared.task
+        boot_timeout = instance.container.boot_timeout
+        if boot_timeout is None:
+            boot_timeout = self.app.config["bay"]["boot_timeout"]
+        boot_deadline = prepared.boot_start + boot_timeout if boot_timeout else None
+        try:
+            try:
+                # Make a towline instance and wait on it
+                towline = Towline.for_instance(self.host, instance)
+                while True:
+                    status, message = towline.status
+                    if status is None:
+                        if message is not None:
+                            start_task.update(status=message)
+                    elif status is True:
+                        break
+                    elif status is False:
+                        raise ContainerBootFailure(
+                            "Failed during towline",
+                            instance=instance,
+                        )
+                    if boot_deadline is not None and time.time() >= boot_deadline:
+                        start_task.update(status="Timed out", status_flavor=Task.FLAVOR_BAD)
+                        raise ContainerBootFailure(
+                            "Did not finish booting within {} seconds".format(boot_timeout),
+                            instance=instance,
+                        )
+                    towline.wait(0.5)
 
                 try:
                     # Replace the instance with an introspected copy of the live one so it has networking details
@@ -335,13 +662,22 @@ class FormationRunner:
                         "Failed after towline",
                         instance=instance,
                     )
+                self.snapshot.instance_started(instance)
 
-                # Run plugins
+                # Waits must finish within the same deadline
+                instance.boot_deadline = boot_deadline
+                # Run plugins (this includes waits)
                 self.app.run_hooks(PluginHook.POST_RUN_CONTAINER, host=self.host, instance=instance, task=start_task)
+                self.boot_history.record(
+                    instance.container.name,
+                    prepared.create_duration + time.time() - prepared.boot_start,
+                )
                 self.app.run_hooks(
                     PluginHook.POST_RUN_CONTAINER_FULLY_STARTED, host=self.host, instance=instance, task=start_task)
 
             except ContainerBootFailure as e:
+                # We don't know what state it was left in, so look again next time we're asked
+                self.snapshot.invalidate()
                 message = "{}\n\n{}".format(
                     "Container {} failed to boot! ({})".format(e.instance.container.name, e.message),
                     self.host.client.logs(e.instance.name, tail=10).decode('utf-8'),
@@ -353,3 +689,37 @@ class FormationRunner:
                 )
 
             start_task.finish(status="Done", status_flavor=Task.FLAVOR_GOOD)
+            # Let anyone waiting to start it too know it's done
+            self.release_prepared(prepared.instance, result=STARTED)
+        finally:
+            self.release_prepared(prepared.instance)
+
+    def release_prepared(self, instance, result=None):
+        """
+        Forgets a prepared container, releasing its boot capacity and its
+        container manipulation lock (passing result on to anyone waiting for
+        it). Safe to call more than once.
+        """
+        prepared = self.prepared_containers.pop(instance, None)
+        if prepared is None:
+            return
+        if prepared.boot_weight:
+            self.boot_limiter.release(prepared.boot_weight)
+        changing_containers.release(prepared.instance.name, result)
+
+
+@attr.s
+class PreparedContainer:
+    """
+    A container that has been created (or found stopped and reusable) by
+    FormationRunner.prepare_container and is on its way through booting.
+    """
+    instance = attr.ib()
+    task = attr.ib()
+    container_pointer = attr.ib()
+    config_digests = attr.ib()
+    reused = attr.ib()
+    create_duration = attr.ib()
+    # Boot capacity held, once launched
+    boot_weight = attr.ib(default=0)
+    boot_start = attr.ib(default=None)
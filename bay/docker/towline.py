@@ -1,37 +1,154 @@
 import json
+import os
 import tarfile
+import threading
 import time
 from io import BytesIO
 
-from docker.errors import NotFound
+from docker.errors import APIError, NotFound
+
+from .logs import container_started_at, follow_output
 
 
 class Towline(object):
     """
     Process communication helper that can monitor the boot process and
     provide information about what's happening.
+
+    Version 1 containers write their status into files under /tugboat, which
+    we poll. Version 2 containers print their status as JSON lines on their
+    output instead, e.g. {"towline": 2, "message": "Migrating"}, finishing
+    with one that has "complete": true (or false, if the boot failed).
     """
 
     # Number of seconds till we conclude the container doesn't have towline support
     NO_TOWLINE_TIMEOUT = 2
+    # Image label that declares whether an image supports towline ("true", "false" or a version number)
+    IMAGE_LABEL = "com.eventbrite.bay.towline"
 
-    def __init__(self, host, container_name):
+    def __init__(self, host, container_name, version=None):
         self.host = host
         self.container_name = container_name
+        # The towline version the container speaks: 0 for none, or None to probe for version 1
+        self.version = version
         self._first_try = None
+        # When the container was started, so files left from a previous run can be ignored (version 1)
+        self._started = None
+        # Latest status seen on the log stream (version 2 only), and an event set whenever it changes
+        self._stream_status = (None, None)
+        self._stream_changed = threading.Event()
+        self._stream_thread = None
 
-    def _read_file(self, path, default=None):
+    @classmethod
+    def for_instance(cls, host, instance):
         """
-        Helper to read the contents of a file inside a container
+        Makes a Towline for the instance, working out if it supports towline from
+        its bay.yaml or, failing that, its image's labels.
+        """
+        return cls(host, instance.name, version=cls.detect_version(host, instance))
+
+    @classmethod
+    def detect_version(cls, host, instance):
         """
+        Returns the towline version the instance declares it supports (0 for
+        none), or None if it doesn't say.
+        """
+        if instance.container.towline is not None:
+            return int(instance.container.towline)
         try:
+            labels = host.client.inspect_image(instance.image_id)["Config"].get("Labels") or {}
+        except NotFound:
+            return None
+        label = labels.get(cls.IMAGE_LABEL)
+        if label is None:
+            return None
+        label = label.lower()
+        if label.isdigit():
+            return int(label)
+        return 1 if label in ("true", "yes") else 0
+
+    def _follow_stream(self):
+        """
+        Reads the container's output as it's produced, picking out towline
+        status lines. Runs in a background thread until boot finishes or the
+        container stops.
+        """
+        try:
+            for line in follow_output(self.host, self.container_name):
+                status = self._parse_stream_line(line)
+                if status is not None:
+                    self._stream_status = status
+                    self._stream_changed.set()
+                    if status[0] is not None:
+                        return
+        except NotFound:
+            # The container went away; the status checks will notice
+            pass
+        except APIError as e:
+            # Its output can't be read (e.g. a logging driver that doesn't support it)
+            self._stream_status = (False, "Cannot follow towline output: {}".format(e))
+        finally:
+            self._stream_changed.set()
+
+    @staticmethod
+    def _parse_stream_line(line):
+        """
+        Turns a line of output into a (finished, message) status, or None if
+        it isn't a towline line.
+        """
+        line = line.strip()
+        if not line.startswith(b"{"):
+            return None
+        try:
+            payload = json.loads(line.decode("utf8"))
+        except ValueError:
+            return None
+        if not isinstance(payload, dict) or "towline" not in payload:
+            return None
+        message = (payload.get("message") or "").rstrip(":") or None
+        complete = payload.get("complete")
+        if complete is True:
+            return (True, message or "Towline boot complete")
+        elif complete is False:
+            return (False, message or "Towline boot failed")
+        return (None, message)
+
+    def wait(self, timeout):
+        """
+        Waits until it's worth checking the status again - for streaming
+        containers, that's as soon as a new status arrives, and for the others
+        it's as soon as the container dies, if we're following the host's events.
+        """
+        if self.version == 2 and self._stream_thread is not None:
+            self._stream_changed.wait(timeout)
+            self._stream_changed.clear()
+        elif self.host.state_mirror.live:
+            self.host.state_mirror.wait_for_state(self.container_name, running=False, timeout=timeout)
+        else:
+            time.sleep(timeout)
+
+    def _read_files(self, path):
+        """
+        Helper to read the contents of all files in a directory inside a container
+        with a single archive fetch. Returns a dict of {filename: contents}.
+
+        Files last written before the container was started are left out, as
+        a stopped container that's started again keeps them from its last run.
+        """
+        try:
+            if self._started is None:
+                self._started = container_started_at(self.host, self.container_name)
             tar_stream = self.host.client.get_archive(self.container_name, path)[0]
             tar = tarfile.open(fileobj=BytesIO(tar_stream.read()))
-            contents = tar.extractfile(tar.getmembers()[0]).read().strip()
-            return contents or default
+            return {
+                os.path.basename(member.name): tar.extractfile(member).read().strip()
+                for member in tar.getmembers()
+                # Archive times are whole seconds, so anything from the second it started counts
+                if member.isfile() and member.mtime >= self._started[0]
+            }
         except NotFound:
             # Ignore missing containers or other errors
-            return default
+            return {}
 
     @property
     def status(self):
@@ -46,15 +163,26 @@ class Towline(object):
         # If it's dead, that's a failed boot
         if not self.host.container_running(self.container_name):
             return (False, "Container died during boot")
+        # Containers that say they don't do towline are done as soon as they're running
+        if self.version == 0:
+            return (True, "Non-towline boot complete")
+        # Streaming containers tell us their status on their output
+        if self.version == 2:
+            if self._stream_thread is None:
+                self._stream_thread = threading.Thread(target=self._follow_stream, daemon=True)
+                self._stream_thread.start()
+            return self._stream_status
         # See if we can read a status from it
         if self._first_try is None:
             self._first_try = time.time()
-        container_status = self._read_file("/tugboat/boot_status")
+        files = self._read_files("/tugboat")
+        container_status = files.get("boot_status") or None
         # If there's no status and the timeout has passed, they're not towline compatible
-        if container_status is None and time.time() - self._first_try > self.NO_TOWLINE_TIMEOUT:
+        # (unless they've told us they are, in which case they're just slow to start reporting)
+        if container_status is None and not self.version and time.time() - self._first_try > self.NO_TOWLINE_TIMEOUT:
             return (True, "Non-towline boot complete")
         # See if boot is complete
-        if self._read_file("/tugboat/boot_complete"):
+        if files.get("boot_complete"):
             return (True, "Towline boot complete")
         elif container_status:
             # Try to parse out a JSON thing
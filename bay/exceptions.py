@@ -54,6 +54,30 @@ class ContainerBootFailure(DockerRuntimeError):
     """
 
 
+class PartialRunFailure(DockerRuntimeError):
+    """
+    Raised in keep-going mode once everything that could run has finished,
+    if some instances failed (and so anything depending on them was skipped).
+    """
+
+    def __init__(self, failures, skipped):
+        self.failures = failures
+        self.skipped = skipped
+        failed_names = sorted(instance.container.name for instance in failures)
+        message = "{} container(s) failed: {}".format(len(failed_names), ", ".join(failed_names))
+        if skipped:
+            message += "\nSkipped as they depend on failed containers: {}".format(
+                ", ".join(sorted(instance.container.name for instance in skipped)),
+            )
+        for instance, exception in sorted(failures.items(), key=lambda item: item[0].name):
+            message += "\n\n{}".format(exception)
+        super(PartialRunFailure, self).__init__(
+            message,
+            code="PARTIAL_FAIL",
+            instance=sorted(failures, key=lambda instance: instance.name)[0],
+        )
+
+
 class RegistryRequiresLogin(Exception):
     """
     Raised by a registry handler when a registry has not been logged in to
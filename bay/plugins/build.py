@@ -10,7 +10,6 @@ from ..cli.argument_types import ContainerType, HostType
 from ..cli.tasks import Task
 from ..constants import PluginHook
 from ..docker.build import Builder
-from ..docker.introspect import FormationIntrospector
 from ..docker.runner import FormationRunner
 from ..exceptions import BuildFailureError, ImagePullFailure
 from .gc import GarbageCollector
@@ -117,7 +116,7 @@ class BuildPlugin(BasePlugin):
 
         if should_extract_volume():
             # Stop all containers that have the volume mounted
-            formation = FormationIntrospector(host, self.app.containers).introspect()
+            formation = self.app.formation_snapshot(host).introspect()
             # Keep track of instances to remove after they are stopped
             instances_to_remove = formation.get_instances_using_volume(provides_volume)
             if instances_to_remove:
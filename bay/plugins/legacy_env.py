@@ -15,16 +15,30 @@ class LegacyEnvPlugin(BasePlugin):
         Takes the instance and modifies the environment to have legacy link variables.
         """
         for alias, target in instance.links.items():
-            # Ask Docker for all open ports
-            ports = host.client.inspect_container(target.name)['NetworkSettings']['Ports']
-            if ports:
-                for port, _ in ports.items():
-                    number, protocol = port.split("/")
-                    name = "{}_1_PORT_{}_{}".format(
-                        alias.replace("-", "_").upper(),
-                        number,
-                        protocol.upper(),
-                    )
-                    instance.environment[name] = "{}://{}:{}".format(protocol, alias, number)
-                    instance.environment[name + "_ADDR"] = alias
-                    instance.environment[name + "_PORT"] = number
+            for port in sorted(self.exposed_ports(host, target)):
+                number, protocol = port.split("/")
+                name = "{}_1_PORT_{}_{}".format(
+                    alias.replace("-", "_").upper(),
+                    number,
+                    protocol.upper(),
+                )
+                instance.environment[name] = "{}://{}:{}".format(protocol, alias, number)
+                instance.environment[name + "_ADDR"] = alias
+                instance.environment[name + "_PORT"] = number
+
+    def exposed_ports(self, host, target):
+        """
+        Returns the set of "number/protocol" ports the target instance will
+        expose: the ones its image exposes plus the ones it is configured with.
+        This comes from the instance and its image rather than the running
+        container, so the target does not need to exist yet.
+        """
+        ports = set()
+        if target.image_id:
+            image_details = self.app.formation_snapshot(host).inspect_image(target.image_id)
+            image_ports = image_details['Config'].get('ExposedPorts')
+            ports.update((image_ports or {}).keys())
+        for port in target.ports.keys():
+            port = str(port)
+            ports.add(port if "/" in port else port + "/tcp")
+        return ports
@@ -4,13 +4,12 @@ import attr
 import click
 
 from .base import BasePlugin
-from .run import run_formation
+from .run import profile_formation, run_formation
 from ..cli.argument_types import HostType
 from ..cli.colors import CYAN, RED
 from ..cli.table import Table
 from ..cli.tasks import Task
 from ..containers.profile import Profile, NullProfile
-from ..docker.introspect import FormationIntrospector
 
 
 @attr.s
@@ -24,6 +23,7 @@ class ProfilesPlugin(BasePlugin):
     def load(self):
         self.add_command(profile)
         self.add_command(up)
+        self.add_command(plan)
         self.add_command(list_profiles)
 
 
@@ -69,39 +69,31 @@ def profile(app, name, host):
 
 @click.command()
 @click.option("--host", "-h", type=HostType(), default="default")
+@click.option("--dry-run", is_flag=True, default=False, help="Show what would change without changing it")
+@click.option("--keep-going", "-k", is_flag=True, default=False,
+              help="Keep starting containers that do not depend on one that failed")
 @click.pass_obj
-def up(app, host):
+def up(app, host, dry_run, keep_going):
     """
     Start up a profile by booting the default containers.
     Leaves any other containers that are running (shell, ssh-agent, etc.) alone.
     """
     profile = app.profiles[1] if app.profiles and len(app.profiles) > 1 else None
-    ignore_dependencies = profile.ignore_dependencies if profile else False
     if profile:
         click.echo("Starting up profile %s..." % CYAN(profile.name))
-    # Do removal loop first so we don't step on adding containers later
-    formation = FormationIntrospector(host, app.containers).introspect()
-    for instance in list(formation):
-        # We remove all non-system containers, so that means ssh-agent and similar
-        # containers will survive the process.
-        if not instance.container.system and instance.formation:
-            formation.remove_instance(instance)
-
-    # Now add in containers (listed in yaml profile file)
-    profile_containers = []
-    for container in app.containers:
-        if app.containers.options(container).get('default_boot'):
-            profile_containers.append(container)
-            formation.add_container(container, host, ignore_dependencies)
-
-    if app.profiles[1].ignore_dependencies:
-        for instance in list(formation):
-            # Remove all dependent containers not listed in the profile file
-            if not instance.container.system and instance.container not in profile_containers:
-                formation.remove_instance(instance, True)
-
+    formation = profile_formation(app, host)
     task = Task("Restarting containers", parent=app.root_task)
-    run_formation(app, host, formation, task)
+    run_formation(app, host, formation, task, dry_run=dry_run, keep_going=keep_going)
+
+
+@click.command()
+@click.option("--host", "-h", type=HostType(), default="default")
+@click.pass_obj
+def plan(app, host):
+    """
+    Shows what `bay up` would change, without changing anything.
+    """
+    app.invoke("up", host=host, dry_run=True)
 
 
 @click.command()
@@ -6,6 +6,7 @@ from ..cli.argument_types import HostType
 from ..cli.table import Table
 from ..docker.introspect import FormationIntrospector
 from ..utils import humanize
+from ..utils.threading import parallel_map
 
 
 @attr.s
@@ -42,16 +43,21 @@ def ps(app, host, stats):
             ("DOCKER NAME", 40),
             ("PORTS (CONTAINER->HOST)", 30),
         ])
+    instances = sorted(formation, key=lambda i: i.name)
+    if stats:
+        # Get the memory usage from the docker host, for all containers at once
+        memory_usage = parallel_map(
+            lambda instance: host.client.stats(instance.name, decode=True, stream=False)['memory_stats']['usage'],
+            instances,
+        )
     table.print_header()
-    for instance in sorted(formation, key=lambda i: i.name):
+    for index, instance in enumerate(instances):
         row = [
             instance.container.name,
             instance.name,
         ]
         if stats:
-            # Get the memory usage from the docker host
-            stats = host.client.stats(instance.name, decode=True, stream=False)
-            row.append(humanize.file_size(stats['memory_stats']['usage']))
+            row.append(humanize.file_size(memory_usage[index]))
         # Add in port info
         row.append(", ".join(
             "{}->{}".format(private, public)
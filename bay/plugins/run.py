@@ -4,12 +4,11 @@ import sys
 
 from .base import BasePlugin
 from ..cli.argument_types import ContainerType, HostType
-from ..cli.colors import CYAN, RED
+from ..cli.colors import CYAN, GREEN, RED, YELLOW
 from ..cli.tasks import Task
 from ..constants import PluginHook
-from ..docker.introspect import FormationIntrospector
 from ..docker.runner import FormationRunner
-from ..exceptions import DockerRuntimeError, ImageNotFoundException
+from ..exceptions import DockerRuntimeError, ImageNotFoundException, PartialRunFailure
 
 
 @attr.s
@@ -25,6 +24,7 @@ class RunPlugin(BasePlugin):
         self.add_alias(run, "start")
         self.add_command(shell)
         self.add_command(stop)
+        self.add_alias(stop, "down")
         self.add_command(restart)
         self.add_alias(restart, "hup")
         self.add_alias(restart, "reload")
@@ -34,43 +34,24 @@ class RunPlugin(BasePlugin):
 @click.argument("containers", type=ContainerType(), nargs=-1)
 @click.option("--host", "-h", type=HostType(), default="default")
 @click.option("--tail/--notail", "-t", default=False)
+@click.option("--dry-run", is_flag=True, default=False, help="Show what would change without changing it")
+@click.option("--keep-going", "-k", is_flag=True, default=False,
+              help="Keep starting containers that do not depend on one that failed")
 @click.pass_obj
-def run(app, containers, host, tail):
+def run(app, containers, host, tail, dry_run, keep_going):
     """
     Runs containers by name, including any dependencies needed
     """
-    profile = app.profiles[1] if app.profiles and len(app.profiles) > 1 else None
-    ignore_dependencies = profile.ignore_dependencies if profile else False
     # Get the current formation
-    formation = FormationIntrospector(host, app.containers).introspect()
+    formation = app.formation_snapshot(host).introspect()
     # Make a Formation that represents what we want to do by taking the existing
     # state and adding in the containers we want
-    for container in containers:
-        try:
-            formation.add_container(container, host, ignore_dependencies)
-        except ImageNotFoundException as e:
-            # If it's the container we're trying to add directly, have one error -
-            # otherwise, say it's a link
-            if e.image == container.image_name:
-                click.echo(RED(
-                    "This container ({name}) does not have a built image. Try `bay build {name}` first.".format(
-                        name=container.name,
-                    )
-                ))
-                sys.exit(1)
-            elif hasattr(e, "container"):
-                click.echo(RED("No image for linked container {name} - try `bay build {name}` first.".format(
-                    name=e.container.name,
-                )))
-                sys.exit(1)
-            else:
-                click.echo(RED("No image for linked container %s!" % e.image))
-                sys.exit(1)
+    add_containers(app, host, formation, containers)
     # Run that change
     task = Task("Starting containers", parent=app.root_task)
-    run_formation(app, host, formation, task, containers)
+    run_formation(app, host, formation, task, containers, dry_run=dry_run, keep_going=keep_going)
     # If they asked to tail, then run tail
-    if tail:
+    if tail and not dry_run:
         if len(containers) != 1:
             click.echo(RED("You cannot tail more than one container!"))
             sys.exit(1)
@@ -90,7 +71,7 @@ def shell(app, container, host, command, shell_path):
     profile = app.profiles[1] if app.profiles and len(app.profiles) > 1 else None
     ignore_dependencies = profile.ignore_dependencies if profile else False
     # Get the current formation
-    formation = FormationIntrospector(host, app.containers).introspect()
+    formation = app.formation_snapshot(host).introspect()
     # Make a Formation with that container launched with bash in foreground
     try:
         instance = formation.add_container(container, host, ignore_dependencies)
@@ -110,42 +91,156 @@ def shell(app, container, host, command, shell_path):
 @click.command()
 @click.argument("containers", type=ContainerType(), nargs=-1)
 @click.option("--host", "-h", type=HostType(), default="default")
+@click.option("--dry-run", is_flag=True, default=False, help="Show what would change without changing it")
+@click.option("--fast", is_flag=True, default=False,
+              help="Kill containers straight away, a dependency level at a time, rather than stopping them gracefully")
 @click.pass_obj
-def stop(app, containers, host):
+def stop(app, containers, host, dry_run, fast):
     """
     Stops containers and ones that depend on them
     """
-    formation = FormationIntrospector(host, app.containers).introspect()
-    # Look through the formation and remove the containers matching the name
-    for instance in list(formation):
-        # If there are no names, then we remove everything
-        if instance.container in containers or (not containers and not instance.container.system):
-            # Make sure that it was not removed already as a dependent
-            if instance.formation:
-                formation.remove_instance(instance)
+    formation = app.formation_snapshot(host).introspect()
+    remove_containers(formation, containers)
     # Run the change
     task = Task("Stopping containers", parent=app.root_task)
-    run_formation(app, host, formation, task)
+    run_formation(app, host, formation, task, dry_run=dry_run, fast_stop=fast)
 
 
 @click.command()
 @click.argument("containers", type=ContainerType(), nargs=-1)
 @click.option("--host", "-h", type=HostType(), default="default")
+@click.option("--dry-run", is_flag=True, default=False, help="Show what would change without changing it")
+@click.option("--keep-going", "-k", is_flag=True, default=False,
+              help="Keep starting containers that do not depend on one that failed")
 @click.pass_obj
-def restart(app, containers, host):
+def restart(app, containers, host, dry_run, keep_going):
     """
     Stops and then starts containers.
     """
+    if dry_run:
+        # Work out what the stop would take down, then plan the start phase as if it had happened
+        current_formation = app.formation_snapshot(host).introspect()
+        stopped_formation = current_formation.clone()
+        remove_containers(stopped_formation, containers)
+        stopped = {instance.name for instance in current_formation if instance not in stopped_formation}
+        task = Task("Restarting containers", parent=app.root_task)
+        if containers:
+            add_containers(app, host, stopped_formation, containers)
+            run_formation(app, host, stopped_formation, task, containers, dry_run=True, force_restart=stopped)
+        else:
+            run_formation(app, host, profile_formation(app, host), task, dry_run=True, force_restart=stopped)
+        return
     app.invoke("stop", containers=containers, host=host)
     if containers:
-        app.invoke("run", containers=containers, host=host)
+        app.invoke("run", containers=containers, host=host, keep_going=keep_going)
     else:
-        app.invoke("up", host=host)
+        app.invoke("up", host=host, keep_going=keep_going)
+
+
+def add_containers(app, host, formation, containers):
+    """
+    Adds the given containers (and their dependencies) to the formation,
+    exiting with a helpful message if any of them have no image.
+    """
+    profile = app.profiles[1] if app.profiles and len(app.profiles) > 1 else None
+    ignore_dependencies = profile.ignore_dependencies if profile else False
+    for container in containers:
+        try:
+            formation.add_container(container, host, ignore_dependencies)
+        except ImageNotFoundException as e:
+            # If it's the container we're trying to add directly, have one error -
+            # otherwise, say it's a link
+            if e.image == container.image_name:
+                click.echo(RED(
+                    "This container ({name}) does not have a built image. Try `bay build {name}` first.".format(
+                        name=container.name,
+                    )
+                ))
+                sys.exit(1)
+            elif hasattr(e, "container"):
+                click.echo(RED("No image for linked container {name} - try `bay build {name}` first.".format(
+                    name=e.container.name,
+                )))
+                sys.exit(1)
+            else:
+                click.echo(RED("No image for linked container %s!" % e.image))
+                sys.exit(1)
 
 
-def run_formation(app, host, formation, task, arg_containers=[]):
+def profile_formation(app, host):
+    """
+    Returns the formation `bay up` starts: the running system containers
+    (ssh-agent, etc.) plus the active profile's default containers.
+    """
+    profile = app.profiles[1] if app.profiles and len(app.profiles) > 1 else None
+    ignore_dependencies = profile.ignore_dependencies if profile else False
+    # Do removal first so we don't step on adding containers later
+    formation = app.formation_snapshot(host).introspect()
+    remove_containers(formation, [])
+
+    # Now add in containers (listed in yaml profile file)
+    profile_containers = []
+    for container in app.containers:
+        if app.containers.options(container).get('default_boot'):
+            profile_containers.append(container)
+            formation.add_container(container, host, ignore_dependencies)
+
+    if ignore_dependencies:
+        for instance in list(formation):
+            # Remove all dependent containers not listed in the profile file
+            if not instance.container.system and instance.container not in profile_containers:
+                formation.remove_instance(instance, True)
+    return formation
+
+
+def remove_containers(formation, containers):
+    """
+    Removes the instances of the given containers (and the ones that depend on
+    them) from the formation, or all non-system instances if none are given.
+    """
+    for instance in list(formation):
+        # If there are no names, then we remove everything
+        if instance.container in containers or (not containers and not instance.container.system):
+            # Make sure that it was not removed already as a dependent
+            if instance.formation:
+                formation.remove_instance(instance)
+
+
+def print_plan(plan, estimated_duration):
+    """
+    Prints a FormationPlan for the user.
+    """
+    if plan.empty:
+        click.echo(GREEN("No changes."))
+        return
+    click.echo("Plan: {} to add, {} to restart, {} to remove".format(
+        len(plan.added),
+        len(plan.restarted),
+        len(plan.removed),
+    ))
+    for instance in sorted(plan.added, key=lambda i: i.name):
+        click.echo(GREEN("  + {}".format(instance.container.name)))
+    for instance, changes in sorted(plan.restarted.items(), key=lambda item: item[0].name):
+        click.echo(YELLOW("  ~ {} ({})".format(instance.container.name, ", ".join(changes))))
+    for instance in sorted(plan.removed, key=lambda i: i.name):
+        click.echo(RED("  - {}".format(instance.container.name)))
+    waves = plan.start_waves()
+    if waves:
+        click.echo(CYAN("Start waves:"))
+        for i, wave in enumerate(waves):
+            click.echo("  {}: {}".format(i + 1, ", ".join(sorted(instance.container.name for instance in wave))))
+        click.echo(CYAN("Estimated start time: ") + "{:.0f}s".format(estimated_duration))
+
+
+def run_formation(
+    app, host, formation, task, arg_containers=[], dry_run=False, force_restart=(), keep_going=False, fast_stop=False,
+):
     """
     Common function to run a formation change.
+
+    If dry_run is set, the changes are printed rather than made. If keep_going
+    is set, a failing container only stops the containers that depend on it.
+    If fast_stop is set, containers being stopped are killed straight away.
     """
     profile = app.profiles[1] if app.profiles and len(app.profiles) > 1 else None
     ignore_dependencies = profile.ignore_dependencies if profile else False
@@ -159,19 +254,35 @@ def run_formation(app, host, formation, task, arg_containers=[]):
             if not instance.container.system and c not in profile_containers and c not in arg_containers:
                 formation.remove_instance(instance, True)
 
+    if dry_run:
+        runner = FormationRunner(app, host, formation, task)
+        plan = runner.plan(force_restart=force_restart)
+        task.finish(status="Dry run", status_flavor=Task.FLAVOR_NEUTRAL)
+        print_plan(plan, runner.estimate_start_duration(plan.to_start))
+        return
+
     if run_hook:
         app.run_hooks(PluginHook.PRE_GROUP_START, host=host, formation=formation, task=task)
     container_in_error = None
     error_message = None
-    show_tail_message = False
+    tail_containers = []
     try:
-        FormationRunner(app, host, formation, task).run()
+        FormationRunner(app, host, formation, task, keep_going=keep_going, fast_stop=fast_stop).run()
+    # Some containers failed but everything else that could start did
+    except PartialRunFailure as e:
+        container_in_error = e.instance.container
+        error_message = str(e)
+        tail_containers = sorted(
+            instance.container.name
+            for instance, exception in e.failures.items()
+            if getattr(exception, "code", None) == "BOOT_FAIL"
+        )
     # General docker/runner error
     except DockerRuntimeError as e:
         container_in_error = e.instance.container
         error_message = str(e)
         if e.code == "BOOT_FAIL":
-            show_tail_message = True
+            tail_containers = [container_in_error.name]
     # An image was not found
     except ImageNotFoundException as e:
         container_in_error = e.instance.container
@@ -183,7 +294,7 @@ def run_formation(app, host, formation, task, arg_containers=[]):
                   container_in_error=container_in_error, error_message=error_message)
     if error_message:
         click.echo(RED(error_message))
-        if show_tail_message:
-            click.echo(CYAN("You can see its output with `bay tail {}`.".format(container_in_error.name)))
+        for name in tail_containers:
+            click.echo(CYAN("You can see the output of {0} with `bay tail {0}`.".format(name)))
     else:
         task.finish(status="Done", status_flavor=Task.FLAVOR_GOOD)
@@ -5,7 +5,6 @@ import click
 import subprocess
 
 from .base import BasePlugin
-from ..docker.introspect import FormationIntrospector
 from ..exceptions import DockerRuntimeError
 from ..constants import PluginHook
 
@@ -93,11 +92,7 @@ class SSHAgentPlugin(BasePlugin):
         """
         Returns True if the agent container is running on the host, False otherwise.
         """
-        formation = FormationIntrospector(host, self.app.containers).introspect()
-        for instance in formation:
-            if instance.container.name == self.CONTAINER_NAME:
-                return True
-        return False
+        return self.app.formation_snapshot(host).is_running(self.CONTAINER_NAME)
 
     def key_paths(self):
         """
@@ -1,6 +1,5 @@
 from .base import BasePlugin
 from ..constants import PluginHook
-from ..docker.introspect import FormationIntrospector
 
 
 class SystemContainerBuildPlugin(BasePlugin):
@@ -11,7 +10,7 @@ class SystemContainerBuildPlugin(BasePlugin):
 
     def post_group_build(self, host, containers, task):
         """Restart all running system containers whose IDs have changed."""
-        formation = FormationIntrospector(host, self.app.containers).introspect()
+        formation = self.app.formation_snapshot(host).introspect()
         containers_to_restart = set()
         for container in containers:
             if container.system:
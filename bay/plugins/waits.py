@@ -1,13 +1,17 @@
 import attr
 import http.client
+import queue
+import re
 import ssl
 import socket
+import threading
 import time
 from docker.errors import NotFound
 
 from .base import BasePlugin
 from ..cli.tasks import Task
 from ..constants import PluginHook
+from ..docker.logs import follow_output
 from ..exceptions import ContainerBootFailure, DockerRuntimeError
 
 
@@ -19,6 +23,13 @@ class WaitsPlugin(BasePlugin):
 
     provides = ["waits"]
 
+    # Waits are first checked this often, backing off by a factor of BACKOFF each time up to MAX_DELAY
+    MIN_DELAY = 0.1
+    BACKOFF = 1.5
+    MAX_DELAY = 1
+    # How often to check the container is still alive if we can't follow the event stream
+    POLL_INTERVAL = 1
+
     def load(self):
         self.add_hook(PluginHook.POST_RUN_CONTAINER, self.post_start)
         self.add_catalog_type("wait")
@@ -27,11 +38,15 @@ class WaitsPlugin(BasePlugin):
         self.add_catalog_item("wait", "tcp", TcpWait)
         self.add_catalog_item("wait", "time", TimeWait)
         self.add_catalog_item("wait", "file", FileWait)
+        self.add_catalog_item("wait", "log", LogWait)
+        self.add_catalog_item("wait", "healthcheck", HealthcheckWait)
 
     def post_start(self, host, instance, task):
         # Loop through all waits and build instances
         wait_instances = []
-        for wait in instance.container.waits:
+        # {id(wait instance): (deadline, timeout)} (waits aren't hashable)
+        deadlines = {}
+        for wait in instance.container.waits + self.inferred_waits(host, instance):
             # Look up wait in app
             try:
                 wait_class = self.app.get_catalog_items("wait")[wait["type"]]
@@ -39,35 +54,161 @@ class WaitsPlugin(BasePlugin):
                 raise DockerRuntimeError(
                     "Unknown wait type {} for {}".format(wait["type"], instance.container.name)
                 )
-            # Initialise it and attach a task
-            params = wait.get("params", {})
+            # Initialise it and attach a task. Any deadline applies to the wait as a whole.
+            params = dict(wait.get("params", {}))
+            timeout = params.pop("deadline", None)
             params["instance"] = instance
             params["host"] = host
             wait_instance = wait_class(**params)
             wait_instance.task = Task("Waiting for {}".format(wait_instance.description()), parent=task)
             wait_instance.task.update(status="Waiting")
             wait_instances.append(wait_instance)
+            if timeout:
+                deadlines[id(wait_instance)] = (time.time() + float(timeout), timeout)
+
+        if not wait_instances:
+            return
+
+        # Run every wait in its own thread, so a slow check doesn't hold up the others, and have
+        # them (and the event stream, if the container dies) report back on a queue.
+        results = queue.Queue()
+        stop = threading.Event()
+        watch_handle = host.event_watcher.watch(
+            instance.name,
+            lambda event: results.put((None, event)),
+        )
+        threads = [
+            threading.Thread(target=self.run_wait, args=(wait_instance, stop, results), daemon=True)
+            for wait_instance in wait_instances
+        ]
+        try:
+            # The container may have died before we started watching
+            events_available = True
+            self.check_running(host, instance, task)
+            for thread in threads:
+                thread.start()
+            remaining = list(wait_instances)
+            while remaining:
+                # Only time out if there's a deadline coming up, or we lost the event stream and have to poll
+                get_timeout = None if events_available else self.POLL_INTERVAL
+                upcoming = [deadlines[id(other)][0] for other in remaining if id(other) in deadlines]
+                if instance.boot_deadline:
+                    upcoming.append(instance.boot_deadline)
+                next_deadline = min(upcoming, default=None)
+                if next_deadline is not None:
+                    until_deadline = max(next_deadline - time.time(), 0)
+                    get_timeout = until_deadline if get_timeout is None else min(get_timeout, until_deadline)
+                try:
+                    wait_instance, result = results.get(timeout=get_timeout)
+                except queue.Empty:
+                    self.check_deadlines(instance, task, remaining, deadlines)
+                    self.check_running(host, instance, task)
+                    continue
+                if wait_instance is None:
+                    # Message from the event stream - either it died, or the stream went away
+                    if result is not None:
+                        self.container_died(instance, task)
+                    # The stream went away, so poll from now on
+                    events_available = False
+                    self.check_running(host, instance, task)
+                elif isinstance(result, Exception):
+                    task.update(status="Failed", status_flavor=Task.FLAVOR_BAD)
+                    raise DockerRuntimeError(
+                        "Failed while waiting for {}:\n{}".format(instance.container.name, result),
+                    )
+                else:
+                    remaining = [other for other in remaining if other is not wait_instance]
+        finally:
+            stop.set()
+            host.event_watcher.unwatch(instance.name, watch_handle)
 
-        # Check on them all until they finish
-        while wait_instances:
-            # See if the container actually died
-            if not host.container_running(instance.name):
-                task.update(status="Dead", status_flavor=Task.FLAVOR_BAD)
+    def inferred_waits(self, host, instance):
+        """
+        Returns a healthcheck wait for the instance if it should be inferred from
+        its image having a HEALTHCHECK and it doesn't have one already.
+        """
+        infer = instance.container.infer_healthcheck
+        if infer is None:
+            infer = self.app.config["bay"]["infer_healthcheck_waits"]
+        if not infer or any(wait["type"] == "healthcheck" for wait in instance.container.waits):
+            return []
+        try:
+            healthcheck = host.client.inspect_image(instance.image_id)["Config"].get("Healthcheck") or {}
+        except NotFound:
+            return []
+        if healthcheck.get("Test", ["NONE"])[0] == "NONE":
+            return []
+        return [{"type": "healthcheck", "params": {}}]
 
+    def check_deadlines(self, instance, task, remaining, deadlines):
+        """
+        Raises a boot failure if any remaining wait, or the boot as a whole, has run out of time.
+        """
+        now = time.time()
+        for wait_instance in remaining:
+            deadline, timeout = deadlines.get(id(wait_instance), (None, None))
+            if deadline is not None and now >= deadline:
+                wait_instance.task.finish(status="Timed out", status_flavor=Task.FLAVOR_BAD)
+                task.update(status="Timed out", status_flavor=Task.FLAVOR_BAD)
                 raise ContainerBootFailure(
-                    "Failed during waits",
+                    "Timed out after {} seconds waiting for {}".format(timeout, wait_instance.description()),
                     instance=instance,
                 )
-            # Check the waits
-            for wait_instance in list(wait_instances):
-                try:
-                    if wait_instance.ready():
-                        wait_instance.task.finish(status="Done", status_flavor=Task.FLAVOR_GOOD)
-                        wait_instances.remove(wait_instance)
-                except Exception as e:
-                    task.update(status="Failed", status_flavor=Task.FLAVOR_BAD)
-                    raise DockerRuntimeError("Failed while waiting for {}:\n{}".format(instance.container.name, e))
-            time.sleep(1)
+        if instance.boot_deadline and now >= instance.boot_deadline:
+            task.update(status="Timed out", status_flavor=Task.FLAVOR_BAD)
+            raise ContainerBootFailure(
+                "Did not finish booting within its boot timeout (still waiting for {})".format(
+                    ", ".join(wait_instance.description() for wait_instance in remaining),
+                ),
+                instance=instance,
+            )
+
+    def check_running(self, host, instance, task):
+        """
+        Raises a boot failure if the container is no longer running.
+        """
+        if not host.container_running(instance.name):
+            self.container_died(instance, task)
+
+    def container_died(self, instance, task):
+        """
+        Fails the boot of a container that stopped during its waits.
+        """
+        task.update(status="Dead", status_flavor=Task.FLAVOR_BAD)
+        raise ContainerBootFailure(
+            "Failed during waits",
+            instance=instance,
+        )
+
+    def run_wait(self, wait_instance, stop, results):
+        """
+        Checks a single wait until it's ready, backing off between checks,
+        and posts the outcome onto results.
+
+        Waits that can be told when they're ready rather than having to check
+        implement wait_until_ready(stop) instead, which blocks until they are
+        (returning True) or stop is set (returning False).
+        """
+        delay = self.MIN_DELAY
+        try:
+            if hasattr(wait_instance, "wait_until_ready"):
+                if wait_instance.wait_until_ready(stop):
+                    wait_instance.task.finish(status="Done", status_flavor=Task.FLAVOR_GOOD)
+                    results.put((wait_instance, True))
+                return
+            while not stop.is_set():
+                if wait_instance.ready():
+                    wait_instance.task.finish(status="Done", status_flavor=Task.FLAVOR_GOOD)
+                    results.put((wait_instance, True))
+                    return
+                stop.wait(delay)
+                delay = min(delay * self.BACKOFF, self.MAX_DELAY)
+        except Exception as e:
+            results.put((wait_instance, e))
+        finally:
+            # Let waits that hold connections open tidy them up
+            if hasattr(wait_instance, "close"):
+                wait_instance.close()
 
 
 @attr.s
@@ -79,6 +220,7 @@ class TcpWait:
     instance = attr.ib()
     host = attr.ib()
     port = attr.ib(default=80)
+    # Per-attempt connection timeout (the wait's overall "deadline" is handled by WaitsPlugin)
     timeout = attr.ib(default=1)
 
     def ready(self):
@@ -119,6 +261,10 @@ class HttpWait(TcpWait):
 
     connection_class = http.client.HTTPConnection
 
+    def __attrs_post_init__(self):
+        # Kept open between checks so we don't reconnect every time
+        self.connection = None
+
     def _get_connection(self, **kwargs):
         addr, port = self.target()
         return self.connection_class(addr, port, timeout=self.timeout, **kwargs)
@@ -128,6 +274,8 @@ class HttpWait(TcpWait):
             try:
                 conn.request(self.method, self.path, headers=self.headers)
                 response = conn.getresponse()
+                # Read the body so the connection can be used again
+                response.read()
                 if response.status in self.expected_codes:
                     return True
                 return False
@@ -135,15 +283,23 @@ class HttpWait(TcpWait):
                 conn.connect()
                 continue
 
+    def _check(self):
+        if self.connection is None:
+            self.connection = self._get_connection()
+        return self._ready_request(self.connection)
+
     def ready(self):
-        conn = self._get_connection()
         # Run wait
         try:
-            return self._ready_request(conn)
+            return self._check()
         except Exception:
+            self.close()
             return False
-        finally:
-            conn.close()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
 
     def description(self):
         return "HTTP on port {}".format(self.port)
@@ -172,17 +328,16 @@ class HttpsWait(HttpWait):
         return super(HttpsWait, self)._get_connection(context=context)
 
     def ready(self):
-        conn = self._get_connection()
         try:
-            return self._ready_request(conn)
+            return self._check()
         except (ssl.SSLError, ssl.CertificateError):
             # If there is a problem with the cert or SSL connection, error out immediately
+            self.close()
             self.task.update(status="SSL error")
             raise
         except Exception:
+            self.close()
             return False
-        finally:
-            conn.close()
 
     def description(self):
         return "HTTPS on port {}".format(self.port)
@@ -231,3 +386,110 @@ class FileWait:
 
     def description(self):
         return self.waiting_name or "file {}".format(self.path)
+
+
+@attr.s
+class LogWait:
+    """
+    Waits until a line matching a regular expression appears in the container's output
+    """
+
+    instance = attr.ib()
+    host = attr.ib()
+    pattern = attr.ib()
+
+    # How often to check if we've been told to stop while waiting for the line
+    STOP_CHECK_INTERVAL = 0.5
+
+    def __attrs_post_init__(self):
+        self.regex = re.compile(self.pattern)
+        self.matched = threading.Event()
+        self.error = None
+
+    def follow_logs(self):
+        """
+        Reads the container's output (since it was started) until a line matches.
+        """
+        try:
+            for line in follow_output(self.host, self.instance.name):
+                if self.regex.search(line.decode("utf8", "replace")):
+                    self.matched.set()
+                    return
+        except Exception as e:
+            self.error = e
+            self.matched.set()
+
+    def wait_until_ready(self, stop):
+        threading.Thread(target=self.follow_logs, daemon=True).start()
+        while not stop.is_set():
+            if self.matched.wait(self.STOP_CHECK_INTERVAL):
+                if self.error is not None:
+                    raise DockerRuntimeError("Cannot read output of {}: {}".format(self.instance.name, self.error))
+                return True
+        return False
+
+    def description(self):
+        return "log line matching {!r}".format(self.pattern)
+
+
+@attr.s
+class HealthcheckWait:
+    """
+    Waits until Docker reports the container as healthy, using the HEALTHCHECK
+    defined in its image
+    """
+
+    instance = attr.ib()
+    host = attr.ib()
+
+    # How often to check if we've been told to stop (or to poll, if the event stream is lost)
+    STOP_CHECK_INTERVAL = 0.5
+
+    def __attrs_post_init__(self):
+        self.changed = threading.Event()
+        self.health_status = None
+        self.events_available = True
+
+    def on_event(self, event):
+        if event is None:
+            self.events_available = False
+        else:
+            action = event.get("Action") or event.get("status") or ""
+            self.health_status = action.partition(":")[2].strip() or None
+        self.changed.set()
+
+    def current_status(self):
+        """
+        Fetches the container's health status directly.
+        """
+        health = self.host.client.inspect_container(self.instance.name)["State"].get("Health")
+        if not health:
+            raise DockerRuntimeError(
+                "Container {} has no HEALTHCHECK to wait on".format(self.instance.container.name),
+            )
+        return health["Status"]
+
+    def wait_until_ready(self, stop):
+        handle = self.host.event_watcher.watch(self.instance.name, self.on_event, events=["health_status"])
+        try:
+            # It might have become healthy before we started watching
+            status = self.current_status()
+            while not stop.is_set():
+                if status == "healthy":
+                    return True
+                elif status == "unhealthy":
+                    raise DockerRuntimeError(
+                        "Container {} reported itself unhealthy".format(self.instance.container.name),
+                    )
+                self.changed.wait(self.STOP_CHECK_INTERVAL)
+                self.changed.clear()
+                if self.events_available:
+                    status = self.health_status or status
+                else:
+                    status = self.current_status()
+            return False
+        finally:
+            self.host.event_watcher.unwatch(self.instance.name, handle)
+
+    def description(self):
+        return "healthcheck"
@@ -1,30 +1,115 @@
+import heapq
 from collections import deque
 
 
-def dependency_sort(initial, dependencies):
+def _dependency_graph(initial, dependencies):
     """
-    Generic dependency sorting algorithm. Takes initial nodes, and a
-    callable that returns a list of dependencies of a node given a node,
-    and returns a list of the node and its dependencies from most depended
-    (depends on nothing) to the node passed in (depends on everything else)
+    Finds every node reachable from the initial ones, returning
+    ({node: set of its dependencies}, {node: list of nodes depending on it}).
     """
-    deps = list(initial)
     pending = deque(initial)
+    # Everything that's been queued in pending, so checking each edge is a set lookup rather than a scan
+    seen = set(initial)
     mapping = {}
+    dependents = {}
     while pending:
         current = pending.popleft()
-        mapping[current] = [x for x in dependencies(current) if x is not None]
+        mapping[current] = {x for x in dependencies(current) if x is not None}
+        dependents.setdefault(current, [])
         for dep in mapping[current]:
-            if dep not in pending and dep not in mapping:
+            dependents.setdefault(dep, []).append(current)
+            if dep not in seen:
+                seen.add(dep)
                 pending.append(dep)
-    # Now roll through building a sorted list
+    return mapping, dependents
+
+
+def _circular_error(mapping, placed):
+    return ValueError("Circular dependency detected between: %s" % [node for node in mapping if node not in placed])
+
+
+def dependency_sort(initial, dependencies):
+    """
+    Generic dependency sorting algorithm. Takes initial nodes, and a
+    callable that returns a list of dependencies of a node given a node,
+    and returns a list of the node and its dependencies from most depended
+    (depends on nothing) to the node passed in (depends on everything else)
+    """
+    mapping, dependents = _dependency_graph(initial, dependencies)
+    # Kahn's algorithm, taking the alphabetically first of the nodes that are ready each time
+    waiting_on = {node: len(deps) for node, deps in mapping.items()}
+    ready = [node for node, count in waiting_on.items() if not count]
+    heapq.heapify(ready)
     result = []
-    while mapping:
-        len_before = len(mapping)
-        for node, deps in sorted(mapping.items()):
-            if not deps or all((dep in result) for dep in deps):
-                result.append(node)
-                del mapping[node]
-        if len(mapping) == len_before:
-            raise ValueError("Circular dependency detected between: %s" % mapping.keys())
+    while ready:
+        node = heapq.heappop(ready)
+        result.append(node)
+        for dependent in dependents[node]:
+            waiting_on[dependent] -= 1
+            if not waiting_on[dependent]:
+                heapq.heappush(ready, dependent)
+    if len(result) < len(mapping):
+        raise _circular_error(mapping, set(result))
+    return result
+
+
+def dependency_levels(initial, dependencies):
+    """
+    Like dependency_sort, but groups the nodes into levels: a list of
+    sorted lists, where each node only depends on nodes in earlier levels.
+    """
+    mapping, dependents = _dependency_graph(initial, dependencies)
+    waiting_on = {node: len(deps) for node, deps in mapping.items()}
+    level = sorted(node for node, count in waiting_on.items() if not count)
+    levels = []
+    placed = 0
+    while level:
+        levels.append(level)
+        placed += len(level)
+        next_level = []
+        for node in level:
+            for dependent in dependents[node]:
+                waiting_on[dependent] -= 1
+                if not waiting_on[dependent]:
+                    next_level.append(dependent)
+        level = sorted(next_level)
+    if placed < len(mapping):
+        raise _circular_error(mapping, {node for level in levels for node in level})
+    return levels
+
+
+def critical_path_weights(nodes, dependents, weight):
+    """
+    Given nodes, a callable that returns the nodes which depend on a node
+    (restricted to the ones passed in), and a callable that returns the
+    cost of a single node, returns a dict of {node: cost of the most
+    expensive chain starting at that node and running through its dependents}.
+
+    Scheduling the nodes with the highest value first keeps the longest
+    chain moving when there are fewer workers than ready nodes.
+    """
+    nodes = set(nodes)
+    result = {}
+    for start in nodes:
+        if start in result:
+            continue
+        # Iterative post-order walk so deep graphs don't hit the recursion limit
+        stack = [(start, False)]
+        visiting = set()
+        while stack:
+            node, expanded = stack.pop()
+            if node in result:
+                continue
+            children = [child for child in dependents(node) if child in nodes]
+            if expanded:
+                visiting.discard(node)
+                result[node] = weight(node) + max((result[child] for child in children), default=0)
+                continue
+            if node in visiting:
+                raise ValueError("Circular dependency detected involving: %s" % (node, ))
+            visiting.add(node)
+            stack.append((node, True))
+            for child in children:
+                if child not in result:
+                    stack.append((child, False))
     return result
@@ -1,4 +1,8 @@
 import contextlib
+import heapq
+import itertools
+import os
+import queue
 import sys
 import threading
 import time
@@ -39,31 +43,277 @@ class ExceptionalThread(threading.Thread):
 
 class ThreadSet(set):
     """
-    Threadsafe set extended with check-and-set style operations
+    Threadsafe set extended with check-and-set style operations.
+
+    It doubles as a set of keyed locks: acquire blocks until nobody holds the
+    value (waking as soon as the holder releases it), and the holder can
+    leave a result on release (e.g. "started") that is handed to anyone who
+    was waiting, so they don't have to go and check for themselves.
     """
 
     def __init__(self, *args, **kwargs):
         super(ThreadSet, self).__init__(*args, **kwargs)
-        self.lock = threading.Lock()
+        self.lock = threading.Condition()
+        # {value: (release count, result)} - the count lets waiters tell if a release happened while they waited.
+        # Only kept while someone is waiting on the value.
+        self.results = {}
+        # {value: number of threads waiting to acquire it}
+        self.waiting = {}
 
-    def check_and_add(self, value):
+    def acquire(self, value):
         """
-        Checks if value is in the set and if it is not, adds it.
-        Returns False if value is already in the set, True if value was not in the set and was added.
+        Blocks until the value is not in the set, then adds it.
+
+        Returns the result the previous holder released it with, if we had to
+        wait for it, or None otherwise.
         """
         with self.lock:
-            if value in self:
-                return False
-            self.add(value)
-            return True
+            if value not in self:
+                self.add(value)
+                return None
+            waited_from = self.results.get(value, (0, None))[0]
+            self.waiting[value] = self.waiting.get(value, 0) + 1
+            try:
+                while value in self:
+                    self.lock.wait()
+                self.add(value)
+                release_count, result = self.results.get(value, (0, None))
+                return result if release_count > waited_from else None
+            finally:
+                self.waiting[value] -= 1
+                if not self.waiting[value]:
+                    del self.waiting[value]
+                    self.results.pop(value, None)
+
+    def release(self, value, result=None):
+        """
+        Removes a value added by acquire, waking anyone waiting for it and
+        handing them result. It does not have to be called from the same
+        thread that called acquire.
+        """
+        with self.lock:
+            self.discard(value)
+            if value in self.waiting:
+                release_count = self.results.get(value, (0, None))[0]
+                self.results[value] = (release_count + 1, result)
+                self.lock.notify_all()
 
     @contextlib.contextmanager
-    def entry_lock(self, value, interval=1):
+    def entry_lock(self, value):
         """
         Context manager that allows entry when the value is not in the set, and removes it
         once finished.
+
+        Yields a dict with the previous holder's result under "previous" (see
+        acquire); setting "result" in it passes that on to the next holder.
+        """
+        outcome = {"previous": self.acquire(value), "result": None}
+        try:
+            yield outcome
+        finally:
+            self.release(value, outcome["result"])
+
+
+class WorkerPool(object):
+    """
+    Bounded pool of daemon worker threads. Work is submitted under a key, and
+    every finished item is posted to a completion queue as (key, exception)
+    so the caller can react the moment any single item finishes rather than
+    polling the workers.
+
+    When there is more work than workers, items with the highest priority
+    are picked up first (ties run in submission order).
+    """
+
+    def __init__(self, size, completed=None):
+        if size < 1:
+            raise ValueError("Worker pool size must be at least 1")
+        self.size = size
+        self.pending = queue.PriorityQueue()
+        # Several pools can share one completion queue so a caller can wait on all of them at once
+        self.completed = completed if completed is not None else queue.Queue()
+        self.workers = []
+        self.counter = itertools.count()
+
+    def submit(self, key, target, *args, priority=0):
+        """
+        Queues target(*args) to run on the next free worker, starting a new
+        worker if we are still under the size limit.
+        """
+        if len(self.workers) < self.size:
+            worker = threading.Thread(target=self.worker_loop, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        self.pending.put((-priority, next(self.counter), (key, target, args)))
+
+    def worker_loop(self):
+        while True:
+            item = self.pending.get()[2]
+            # None is the shutdown sentinel
+            if item is None:
+                return
+            key, target, args = item
+            try:
+                target(*args)
+            except BaseException:
+                self.completed.put((key, sys.exc_info()[1]))
+            else:
+                self.completed.put((key, None))
+
+    def wait_for_completion(self):
+        """
+        Blocks until an item finishes and returns its (key, exception) pair;
+        exception is None if it finished successfully.
+        """
+        return self.completed.get()
+
+    def shutdown(self):
+        """
+        Discards any work that has not started yet and tells all workers to
+        exit once they finish their current item. Does not wait for them, as
+        they are daemon threads.
+        """
+        while True:
+            try:
+                self.pending.get_nowait()
+            except queue.Empty:
+                break
+        for _ in self.workers:
+            self.pending.put((float("inf"), next(self.counter), None))
+
+
+def parallel_map(function, items, size=8):
+    """
+    Calls function on every item using a WorkerPool of up to "size" threads
+    and returns the results in the same order as the items. If any call
+    raises, the first exception (in item order) is re-raised.
+    """
+    items = list(items)
+    if len(items) <= 1:
+        return [function(item) for item in items]
+    results = [None] * len(items)
+
+    def run(index):
+        results[index] = function(items[index])
+
+    pool = WorkerPool(min(size, len(items)))
+    for index in range(len(items)):
+        pool.submit(index, run, index)
+    exceptions = {}
+    try:
+        for _ in items:
+            index, exception = pool.wait_for_completion()
+            if exception is not None:
+                exceptions[index] = exception
+    finally:
+        pool.shutdown()
+    if exceptions:
+        raise exceptions[min(exceptions)]
+    return results
+
+
+def system_load():
+    """
+    Returns the one-minute load average per CPU, or None if the platform
+    can't tell us.
+    """
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return None
+
+
+class AdaptiveLimiter(object):
+    """
+    Weighted concurrency limiter whose capacity adapts to how well the system
+    is coping. Every so often it looks at the host load and at the recent
+    latency of recorded operations (e.g. Docker API calls): if either looks
+    overloaded the capacity is cut, otherwise it is slowly raised again.
+    Each kind of operation is compared against its own fastest time, as some
+    (like starting a container) are naturally much slower than others.
+
+    Anything heavier than the whole capacity can still run, but only on its own.
+    Waiters are let in highest priority first (ties in the order they arrived).
+    """
+
+    # Minimum number of seconds between capacity adjustments
+    ADJUST_INTERVAL = 2
+    # Load per CPU above which we back off, and below which we may grow
+    OVERLOAD = 1.5
+    UNDERLOAD = 0.8
+    # How many times slower than the fastest seen an operation can get before we back off
+    LATENCY_FACTOR = 3
+    # Latencies below this are treated as noise when comparing against the fastest seen
+    LATENCY_FLOOR = 0.05
+
+    def __init__(self, initial, minimum=1, maximum=None, load_function=system_load):
+        self.minimum = minimum
+        self.maximum = maximum or initial
+        self.capacity = max(self.minimum, min(initial, self.maximum))
+        self.load_function = load_function
+        self.in_use = 0
+        # {operation: fastest seen}, and {operation: recent average}
+        self.baseline_latency = {}
+        self.latency = {}
+        self.last_adjusted = time.time()
+        self.condition = threading.Condition()
+        # Heap of (-priority, arrival order) for everything waiting in acquire
+        self.waiters = []
+        self.counter = itertools.count()
+
+    def acquire(self, weight=1, priority=0):
+        """
+        Blocks until there is room for something of the given weight and
+        nothing with a higher priority is still waiting.
+        """
+        with self.condition:
+            ticket = (-priority, next(self.counter))
+            heapq.heappush(self.waiters, ticket)
+            try:
+                while self.waiters[0] != ticket or (self.in_use and self.in_use + weight > self.capacity):
+                    self.condition.wait(self.ADJUST_INTERVAL)
+                    self._maybe_adjust()
+            finally:
+                self.waiters.remove(ticket)
+                heapq.heapify(self.waiters)
+                # Let the next in line see if it fits too
+                self.condition.notify_all()
+            self.in_use += weight
+
+    def release(self, weight=1):
+        with self.condition:
+            self.in_use -= weight
+            self._maybe_adjust()
+            self.condition.notify_all()
+
+    def record_latency(self, seconds, operation="default"):
+        """
+        Records how long an operation took, to judge how loaded things are.
+        """
+        with self.condition:
+            if operation not in self.baseline_latency or seconds < self.baseline_latency[operation]:
+                self.baseline_latency[operation] = seconds
+            if operation not in self.latency:
+                self.latency[operation] = seconds
+            else:
+                self.latency[operation] = 0.7 * self.latency[operation] + 0.3 * seconds
+            self._maybe_adjust()
+
+    def _maybe_adjust(self):
+        """
+        Adjusts the capacity if it's been long enough. Must be called with the condition held.
         """
-        while not self.check_and_add(value):
-            time.sleep(interval)
-        yield
-        self.remove(value)
+        now = time.time()
+        if now - self.last_adjusted < self.ADJUST_INTERVAL:
+            return
+        self.last_adjusted = now
+        load = self.load_function()
+        slow = any(
+            latency > self.LATENCY_FACTOR * max(self.baseline_latency[operation], self.LATENCY_FLOOR)
+            for operation, latency in self.latency.items()
+        )
+        if slow or (load is not None and load > self.OVERLOAD):
+            self.capacity = max(self.minimum, self.capacity * 0.75)
+        elif load is None or load < self.UNDERLOAD:
+            self.capacity = min(self.maximum, self.capacity + 1)
+        self.condition.notify_all()
@@ -0,0 +1,16 @@
+import types
+
+from bay.containers.formation import ContainerInstance
+
+
+def make_instance(name="web", **kwargs):
+    """
+    Makes a ContainerInstance of a minimal stand-in container for tests.
+    """
+    container = types.SimpleNamespace(name=name, ports={}, init=False, stop_signal=None)
+    return ContainerInstance(
+        name="example.{}.1".format(name),
+        container=container,
+        image_id="sha256:abc",
+        **kwargs
+    )
@@ -0,0 +1,147 @@
+import threading
+import time
+import types
+import unittest
+
+from docker.errors import NotFound
+
+from bay.docker.client_cache import CachingClient, DockerCallCache
+from bay.docker.introspect import FormationIntrospector
+
+
+class FakeClient:
+    """
+    Stands in for a Docker APIClient, counting the inspects it's asked to do.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.images = {
+            "web:latest": {"Id": "sha256:1", "RepoTags": ["web:latest"]},
+            "db:latest": {"Id": "sha256:2", "RepoTags": ["db:latest"]},
+        }
+        self.images["sha256:1"] = self.images["web:latest"]
+
+    def inspect_image(self, name):
+        self.calls += 1
+        # Give concurrent callers a chance to pile up
+        time.sleep(0.05)
+        if name not in self.images:
+            raise NotFound("No such image")
+        return self.images[name]
+
+    def inspect_container(self, name):
+        self.calls += 1
+        return {
+            "Id": "abc",
+            "Name": "/" + name,
+            "State": {"Running": True},
+            "Config": {"Labels": {FormationIntrospector.CONTAINER_LABEL: "web"}},
+        }
+
+    def tag(self, image, repository, tag=None, force=False):
+        pass
+
+    def start(self, container):
+        pass
+
+    def prune_images(self):
+        pass
+
+    def pull(self, repository, tag=None, stream=False):
+        def progress():
+            yield b"pulling"
+            self.images["web:latest"] = {"Id": "sha256:3", "RepoTags": ["web:latest"]}
+            yield b"done"
+        return progress()
+
+
+class DockerCallCacheTests(unittest.TestCase):
+    """
+    Tests caching read-only Docker calls
+    """
+
+    def setUp(self):
+        self.mirror = types.SimpleNamespace(live=False)
+        self.watcher = types.SimpleNamespace(
+            events=["die"],
+            watch=lambda name, callback, events: 1,
+            unwatch=lambda name, handle: None,
+        )
+        self.cache = DockerCallCache(types.SimpleNamespace(state_mirror=self.mirror, event_watcher=self.watcher))
+        self.raw = FakeClient()
+        self.client = CachingClient(self.raw, self.cache)
+
+    def cached_keys(self):
+        return set(self.cache.entries)
+
+    def test_concurrent_calls_shared(self):
+        threads = [threading.Thread(target=self.client.inspect_image, args=("web:latest",)) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.raw.calls, 1)
+
+    def test_remembered(self):
+        self.client.inspect_image("web:latest")
+        self.assertEqual(self.client.inspect_image("web:latest")["Id"], "sha256:1")
+        self.assertEqual(self.raw.calls, 1)
+        self.assertEqual(self.cache.report(), ["inspect_image: 1 of 2 calls from cache (50%)"])
+
+    def test_not_found_remembered(self):
+        for _ in range(2):
+            with self.assertRaises(NotFound):
+                self.client.inspect_image("missing")
+        self.assertEqual(self.raw.calls, 1)
+
+    def test_copies(self):
+        self.client.inspect_image("web:latest")["RepoTags"].append("changed")
+        self.assertEqual(self.client.inspect_image("web:latest")["RepoTags"], ["web:latest"])
+
+    def test_invalidates_changed_object(self):
+        for name in ["web:latest", "sha256:1", "db:latest"]:
+            self.client.inspect_image(name)
+        # Tagging web (with the tag left out) only changes web's image, whether looked up by name or ID
+        self.client.tag("sha256:4", "web")
+        self.assertEqual(self.cached_keys(), {("inspect_image", "db:latest")})
+
+    def test_invalidates_kind(self):
+        self.client.inspect_image("web:latest")
+        self.client.prune_images()
+        self.assertEqual(self.cached_keys(), set())
+
+    def test_invalidates_after_stream(self):
+        self.client.inspect_image("web:latest")
+        stream = self.client.pull("web", tag="latest", stream=True)
+        next(stream)
+        # Something looks at the image while it's still being pulled
+        self.assertEqual(self.client.inspect_image("web:latest")["Id"], "sha256:1")
+        list(stream)
+        self.assertEqual(self.client.inspect_image("web:latest")["Id"], "sha256:3")
+
+    def test_containers_need_events(self):
+        self.client.inspect_container("example.web.1")
+        self.client.inspect_container("example.web.1")
+        self.assertEqual(self.raw.calls, 2)
+        self.mirror.live = True
+        self.client.inspect_container("example.web.1")
+        self.client.inspect_container("example.web.1")
+        self.assertEqual(self.raw.calls, 3)
+        # Events about it, and bay changing it, both mean asking again
+        self.cache.on_container_event({"Actor": {"Attributes": {"name": "example.web.1"}}})
+        self.client.inspect_container("example.web.1")
+        self.client.start({"Id": "abc"})
+        self.client.inspect_container("example.web.1")
+        self.assertEqual(self.raw.calls, 5)
+
+    def test_changed_by(self):
+        self.assertEqual(
+            DockerCallCache.changed_by("connect_container_to_network", ("example.web.1", "example"), {}),
+            {"container": {"example.web.1"}, "network": {"example"}},
+        )
+        self.assertEqual(
+            DockerCallCache.changed_by("build", (".",), {"tag": "registry:5000/web"}),
+            {"image": {"registry:5000/web", "registry:5000/web:latest"}},
+        )
+        self.assertEqual(DockerCallCache.changed_by("create_container", ("web",), {}), {"container": None})
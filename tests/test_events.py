@@ -0,0 +1,178 @@
+import threading
+import time
+import types
+import unittest
+
+from bay.docker.events import ContainerEventWatcher, HostStateMirror
+from bay.docker.introspect import FormationIntrospector
+
+
+class FakeWatcher:
+    """
+    Stands in for a host's ContainerEventWatcher with its stream already open.
+    """
+
+    def __init__(self):
+        self.connected = threading.Event()
+        self.connected.set()
+        self.callback = None
+
+    def watch(self, name, callback, events=("die",)):
+        self.callback = callback
+        return 1
+
+    def unwatch(self, name, handle):
+        self.callback = None
+
+
+def make_event(action, name):
+    return {"Action": action, "Actor": {"Attributes": {"name": name, FormationIntrospector.CONTAINER_LABEL: "web"}}}
+
+
+class ContainerEventWatcherTests(unittest.TestCase):
+    """
+    Tests dispatching the event stream to watchers
+    """
+
+    def test_dispatch_order(self):
+        events = [make_event("die", "example.web.1")]
+        # Don't send anything until both watchers are in place
+        watching = threading.Event()
+
+        def stream(decode, filters):
+            # Only bay's containers are asked about
+            self.assertEqual(filters["label"], [FormationIntrospector.CONTAINER_LABEL])
+            watching.wait(5)
+            return iter(events)
+        watcher = ContainerEventWatcher(types.SimpleNamespace(client=types.SimpleNamespace(events=stream)))
+        seen = []
+        finished = threading.Event()
+        watcher.watch("example.web.1", lambda event: seen.append(("web", event)))
+        watcher.watch(None, lambda event: seen.append(("all", event)) if event else finished.set())
+        watching.set()
+        self.assertTrue(finished.wait(5))
+        # Watchers of everything see each event first, and everyone hears when the stream ends
+        self.assertEqual(seen, [("all", events[0]), ("web", events[0]), ("web", None)])
+
+
+class HostStateMirrorTests(unittest.TestCase):
+    """
+    Tests keeping track of container states from the event stream
+    """
+
+    def setUp(self):
+        self.listed = [{"Names": ["/example.web.1"], "State": "running"}]
+        # Events that happen while the container list is being fetched
+        self.during_list = []
+        self.inspects = 0
+        self.running = {}
+        self.host = types.SimpleNamespace(
+            client=types.SimpleNamespace(containers=self.containers),
+            container_running=self.container_running,
+        )
+        self.watcher = FakeWatcher()
+        self.mirror = HostStateMirror(self.host, self.watcher)
+
+    def containers(self, all, filters):
+        for event in self.during_list:
+            self.watcher.callback(event)
+        return self.listed
+
+    def container_running(self, name, ignore_exists=False):
+        self.inspects += 1
+        return self.running.get(name, False)
+
+    def start_mirror(self):
+        """
+        Starts the mirror and waits for it to finish filling in the background.
+        """
+        self.mirror.start()
+        self.mirror.seed_thread.join(5)
+        return self.mirror.live
+
+    def test_start_does_not_block(self):
+        self.watcher.connected.clear()
+        start = time.time()
+        self.assertFalse(self.mirror.start())
+        self.assertLess(time.time() - start, 0.5)
+        # Until it's live, callers have to ask Docker
+        self.assertIsNone(self.mirror.state("example.web.1"))
+        self.watcher.connected.set()
+        self.mirror.seed_thread.join(5)
+        self.assertEqual(self.mirror.state("example.web.1"), HostStateMirror.RUNNING)
+
+    def test_seeded_from_list(self):
+        self.assertTrue(self.start_mirror())
+        self.assertEqual(self.mirror.state("example.web.1"), HostStateMirror.RUNNING)
+        self.assertIsNone(self.mirror.state("example.db.1"))
+
+    def test_events_during_list(self):
+        self.during_list = [make_event("die", "example.web.1")]
+        self.start_mirror()
+        self.assertIsNone(self.mirror.state("example.web.1"))
+
+    def test_events(self):
+        self.start_mirror()
+        self.watcher.callback(make_event("create", "example.db.1"))
+        self.watcher.callback(make_event("start", "example.db.1"))
+        self.assertEqual(self.mirror.state("example.db.1"), HostStateMirror.RUNNING)
+        self.watcher.callback(make_event("die", "example.db.1"))
+        self.assertIsNone(self.mirror.state("example.db.1"))
+
+    def test_unlabelled_events_ignored(self):
+        self.start_mirror()
+        self.watcher.callback({"Action": "start", "Actor": {"Attributes": {"name": "other"}}})
+        self.assertNotIn("other", self.mirror.states)
+
+    def test_record(self):
+        """
+        Bay's own changes show up straight away, and events from before them
+        can't take the state backwards.
+        """
+        self.start_mirror()
+        self.mirror.record("example.web.1", HostStateMirror.STOPPED)
+        self.assertIsNone(self.mirror.state("example.web.1"))
+        # A start event from before the stop turns up late
+        self.watcher.callback(make_event("start", "example.web.1"))
+        self.assertIsNone(self.mirror.state("example.web.1"))
+        # Once the stop's own event has arrived, events apply again
+        self.watcher.callback(make_event("die", "example.web.1"))
+        self.watcher.callback(make_event("start", "example.web.1"))
+        self.assertEqual(self.mirror.state("example.web.1"), HostStateMirror.RUNNING)
+
+    def test_record_during_list(self):
+        self.during_list = [make_event("start", "example.db.1")]
+        self.listed = []
+        original = self.containers
+
+        def containers(all, filters):
+            result = original(all, filters)
+            self.mirror.record("example.web.1", HostStateMirror.RUNNING)
+            return result
+        self.host.client.containers = containers
+        self.start_mirror()
+        self.assertEqual(self.mirror.state("example.web.1"), HostStateMirror.RUNNING)
+        self.assertEqual(self.mirror.state("example.db.1"), HostStateMirror.RUNNING)
+
+    def test_record_not_live(self):
+        self.mirror.record("example.web.1", HostStateMirror.RUNNING)
+        self.assertEqual(self.mirror.states, {})
+
+    def test_wait_for_state(self):
+        self.start_mirror()
+        threading.Timer(0.1, lambda: self.watcher.callback(make_event("die", "example.web.1"))).start()
+        self.assertTrue(self.mirror.wait_for_state("example.web.1", running=False, timeout=5))
+        self.assertEqual(self.inspects, 0)
+        self.assertFalse(self.mirror.wait_for_state("example.web.1", running=True, timeout=0.1))
+
+    def test_stream_lost(self):
+        self.start_mirror()
+        self.watcher.callback(None)
+        self.assertFalse(self.mirror.live)
+        self.assertIsNone(self.mirror.state("example.web.1"))
+        # Without events, it has to ask Docker
+        self.running["example.web.1"] = True
+        self.assertTrue(self.mirror.wait_for_state("example.web.1", running=True, timeout=1))
+        self.assertEqual(self.inspects, 1)
+        # And it waits a while before trying the stream again
+        self.assertFalse(self.mirror.start())
@@ -0,0 +1,56 @@
+import types
+import unittest
+
+from bay.containers.formation import ContainerFormation
+
+from helpers import make_instance
+
+
+class InstanceDifferenceTests(unittest.TestCase):
+    """
+    Tests change detection between desired and running instances
+    """
+
+    def test_field_differences(self):
+        self.assertEqual(make_instance().differences(make_instance()), [])
+        self.assertEqual(
+            make_instance(environment={"A": "1"}).differences(make_instance()),
+            ["environment"],
+        )
+
+    def test_fingerprint_matches(self):
+        desired = make_instance(environment={"A": "1"}, mem_limit=100)
+        # A running instance can't recover environment or mem_limit, but has the recorded fingerprint
+        running = make_instance(recorded_config=desired.config_digests())
+        self.assertEqual(desired.differences(running), [])
+        self.assertFalse(desired.different_from(running))
+
+    def test_fingerprint_differences(self):
+        recorded = make_instance(environment={"A": "1"}).config_digests()
+        running = make_instance(recorded_config=recorded)
+        self.assertEqual(
+            make_instance(environment={"A": "2"}, command=["bash"]).differences(running),
+            ["environment", "command"],
+        )
+
+    def test_foreground_always_differs(self):
+        desired = make_instance(foreground=True)
+        running = make_instance(recorded_config=desired.config_digests())
+        self.assertEqual(desired.differences(running), ["foreground"])
+
+
+class ReverseLinkTests(unittest.TestCase):
+    """
+    Tests the index of which instances link to which
+    """
+
+    def test_reverse_links(self):
+        db = make_instance("db")
+        cache = make_instance("cache")
+        web = make_instance("web", links={"db": db, "cache": cache})
+        worker = make_instance("worker", links={"db": db})
+        formation = ContainerFormation(types.SimpleNamespace(prefix="example"), instances=[db, cache, web, worker])
+        self.assertEqual(
+            formation.reverse_links(),
+            {db: {web, worker}, cache: {web}, web: set(), worker: set()},
+        )
@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+
+from bay.docker.history import BootHistory, StopHistory
+
+
+class HistoryTests(unittest.TestCase):
+    """
+    Tests remembering per-container measurements between runs
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def path(self, filename):
+        return os.path.join(self.directory.name, "example", filename)
+
+    def test_boot_estimate(self):
+        history = BootHistory(self.path("boot_history.json"))
+        self.assertEqual(history.estimate("web"), BootHistory.DEFAULT_DURATION)
+        for duration in [1, 9, 2]:
+            history.record("web", duration)
+        history.record("db", 10)
+        self.assertEqual(history.estimate("web"), 2)
+        # Containers we haven't seen boot are assumed to be typical
+        self.assertEqual(history.estimate("cache"), 6)
+
+    def test_save_merges(self):
+        first = BootHistory(self.path("boot_history.json"))
+        second = BootHistory(self.path("boot_history.json"))
+        first.record("web", 1)
+        second.record("db", 2)
+        first.save()
+        second.save()
+        self.assertEqual(BootHistory(self.path("boot_history.json")).samples, {"web": [1], "db": [2]})
+
+    def test_keeps_latest(self):
+        history = BootHistory(self.path("boot_history.json"))
+        for duration in range(10):
+            history.record("web", duration)
+        self.assertEqual(history.recent("web"), [5, 6, 7, 8, 9])
+
+    def test_keeps_getting_killed(self):
+        history = StopHistory(self.path("stop_history.json"))
+        history.record("web", killed=True)
+        self.assertFalse(history.keeps_getting_killed("web", threshold=2))
+        history.record("web", killed=True)
+        self.assertTrue(history.keeps_getting_killed("web", threshold=2))
+        # Once it stops cleanly, it's not worth mentioning
+        history.record("web", killed=False)
+        self.assertFalse(history.keeps_getting_killed("web", threshold=2))
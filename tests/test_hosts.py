@@ -0,0 +1,115 @@
+import os
+import tempfile
+import time
+import types
+import unittest
+
+from docker.errors import APIError
+
+# The hosts module has to be imported through the CLI package, which imports it first
+import bay.cli  # noqa
+from bay.docker.hosts import ApiVersionCache, Host, RememberedVersionClient
+
+
+class ApiVersionCacheTests(unittest.TestCase):
+    """
+    Tests remembering hosts' API versions between commands
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "state", "api_versions.json")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_remembered(self):
+        ApiVersionCache(self.path).set("unix:///var/run/docker.sock", "1.30")
+        cache = ApiVersionCache(self.path)
+        self.assertEqual(cache.get("unix:///var/run/docker.sock"), "1.30")
+        self.assertIsNone(cache.get("tcp://other:2376"))
+
+    def test_expires(self):
+        cache = ApiVersionCache(self.path, ttl=60)
+        cache.set("unix:///var/run/docker.sock", "1.30")
+        with open(self.path, "w") as fh:
+            fh.write('{"unix:///var/run/docker.sock": {"version": "1.30", "time": %s}}' % (time.time() - 120))
+        self.assertIsNone(cache.get("unix:///var/run/docker.sock"))
+
+    def test_disabled(self):
+        cache = ApiVersionCache(self.path, ttl=0)
+        cache.set("unix:///var/run/docker.sock", "1.30")
+        self.assertIsNone(cache.get("unix:///var/run/docker.sock"))
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_corrupt(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, "w") as fh:
+            fh.write("[not json")
+        cache = ApiVersionCache(self.path)
+        self.assertIsNone(cache.get("unix:///var/run/docker.sock"))
+        cache.set("unix:///var/run/docker.sock", "1.30")
+        self.assertEqual(cache.get("unix:///var/run/docker.sock"), "1.30")
+
+    def test_forget(self):
+        cache = ApiVersionCache(self.path)
+        cache.set("unix:///var/run/docker.sock", "1.30")
+        cache.set("tcp://other:2376", "1.35")
+        cache.forget("unix:///var/run/docker.sock")
+        self.assertIsNone(cache.get("unix:///var/run/docker.sock"))
+        self.assertEqual(cache.get("tcp://other:2376"), "1.35")
+
+
+class RememberedVersionClientTests(unittest.TestCase):
+    """
+    Tests falling back to negotiating the API version when the remembered one is rejected
+    """
+
+    def make_client(self, api_version, supported="1.30"):
+        def version():
+            if api_version > supported:
+                raise APIError("client version {} is too new. Maximum supported API version is {}".format(
+                    api_version,
+                    supported,
+                ))
+            return {"ApiVersion": api_version}
+
+        def stop(name):
+            raise APIError("No such container: {}".format(name))
+        return types.SimpleNamespace(api_version=api_version, version=version, stop=stop)
+
+    def test_too_new(self):
+        renegotiated = []
+
+        def renegotiate():
+            renegotiated.append(True)
+            return self.make_client("1.30")
+        client = RememberedVersionClient(self.make_client("1.35"), renegotiate)
+        self.assertEqual(client.version(), {"ApiVersion": "1.30"})
+        self.assertEqual(client.api_version, "1.30")
+        client.version()
+        self.assertEqual(len(renegotiated), 1)
+
+    def test_other_errors(self):
+        client = RememberedVersionClient(self.make_client("1.30"), lambda: self.fail("Renegotiated"))
+        with self.assertRaises(APIError):
+            client.stop("example.web.1")
+
+
+class ConnectionPoolTests(unittest.TestCase):
+    """
+    Tests sizing the shared client's connection pools
+    """
+
+    def assert_pool_size(self, url):
+        host = Host(alias="default", url=url, tls_ca=None, tls_cert=None, tls_key=None, pool_size=32)
+        client = host.make_api_client("1.30")
+        request_url = client._url("/info")
+        pool = client.get_adapter(request_url).get_connection(request_url)
+        self.assertEqual(pool.pool.maxsize, 32)
+
+    def test_unix(self):
+        self.assert_pool_size("unix:///var/run/docker.sock")
+
+    def test_tcp(self):
+        self.assert_pool_size("tcp://127.0.0.1:2375")
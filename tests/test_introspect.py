@@ -0,0 +1,48 @@
+import types
+import unittest
+
+from bay.containers.formation import ContainerFormation
+from bay.docker.introspect import FormationSnapshot
+
+from helpers import make_instance
+
+
+def make_running_instance(name, **kwargs):
+    instance = make_instance(name, **kwargs)
+    instance.ip_address = "172.17.0.2"
+    instance.port_mapping = {}
+    return instance
+
+
+class FormationSnapshotTests(unittest.TestCase):
+    """
+    Tests the per-command record of what's running
+    """
+
+    def make_snapshot(self, *instances):
+        graph = types.SimpleNamespace(prefix="example")
+        snapshot = FormationSnapshot(host=None, graph=graph)
+        snapshot.formation = ContainerFormation(graph, instances=list(instances))
+        return snapshot
+
+    def test_copies_are_independent(self):
+        db = make_running_instance("db")
+        snapshot = self.make_snapshot(db, make_running_instance("web", links={"db": db}))
+        formation = snapshot.introspect()
+        # Links point within the copy, not back at the snapshot's own instances
+        self.assertIs(formation["example.web.1"].links["db"], formation["example.db.1"])
+        formation.add_instance(make_running_instance("cache"))
+        formation["example.db.1"].environment["A"] = "1"
+        self.assertFalse(snapshot.is_running("cache"))
+        self.assertEqual(snapshot.introspect()["example.db.1"].environment, {})
+
+    def test_started_and_stopped(self):
+        db = make_running_instance("db")
+        snapshot = self.make_snapshot(db)
+        snapshot.instance_started(make_running_instance("web", links={"db": "example.db.1"}))
+        self.assertTrue(snapshot.is_running("web"))
+        self.assertEqual(snapshot.introspect()["example.web.1"].links["db"].name, "example.db.1")
+        snapshot.instance_stopped(db)
+        self.assertFalse(snapshot.is_running("db"))
+        # Links to stopped instances are dropped
+        self.assertEqual(snapshot.introspect()["example.web.1"].links, {})
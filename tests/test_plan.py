@@ -0,0 +1,66 @@
+import types
+import unittest
+
+from bay.containers.formation import ContainerFormation
+from bay.docker.plan import FormationPlan
+
+from helpers import make_instance
+
+
+def make_formation(*instances):
+    return ContainerFormation(types.SimpleNamespace(prefix="example"), instances=instances)
+
+
+class FormationPlanTests(unittest.TestCase):
+    """
+    Tests working out the changes between a running and a desired formation
+    """
+
+    def test_from_formations(self):
+        current = make_formation(make_instance("db"), make_instance("web"), make_instance("old"))
+        desired = make_formation(
+            make_instance("db"),
+            make_instance("web", environment={"A": "1"}),
+            make_instance("new"),
+        )
+        plan = FormationPlan.from_formations(current, desired)
+        self.assertEqual({instance.name for instance in plan.added}, {"example.new.1"})
+        self.assertEqual({instance.name for instance in plan.removed}, {"example.old.1"})
+        self.assertEqual({instance.name: changes for instance, changes in plan.restarted.items()}, {
+            "example.web.1": ["environment"],
+        })
+        self.assertEqual({instance.name for instance in plan.to_start}, {"example.new.1", "example.web.1"})
+
+    def test_force_restart(self):
+        plan = FormationPlan.from_formations(
+            make_formation(make_instance("db")),
+            make_formation(make_instance("db")),
+            force_restart={"example.db.1"},
+        )
+        self.assertEqual(list(plan.restarted.values()), [["restart requested"]])
+
+    def test_empty(self):
+        plan = FormationPlan.from_formations(make_formation(make_instance("db")), make_formation(make_instance("db")))
+        self.assertTrue(plan.empty)
+
+    def test_start_waves(self):
+        db = make_instance("db")
+        cache = make_instance("cache")
+        web = make_instance("web", links={"db": db, "cache": cache})
+        worker = make_instance("worker", links={"web": web})
+        plan = FormationPlan(added={db, cache, web, worker})
+        self.assertEqual(plan.start_waves(), [{db, cache}, {web}, {worker}])
+
+    def test_start_waves_running_links(self):
+        # Links to things that are already running don't hold anything back
+        db = make_instance("db")
+        web = make_instance("web", links={"db": db})
+        plan = FormationPlan(added={web})
+        self.assertEqual(plan.start_waves(), [{web}])
+
+    def test_start_waves_circular(self):
+        db = make_instance("db")
+        web = make_instance("web", links={"db": db})
+        db.links["web"] = web
+        with self.assertRaises(ValueError):
+            FormationPlan(added={db, web}).start_waves()
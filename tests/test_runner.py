@@ -0,0 +1,253 @@
+import os
+import tempfile
+import threading
+import types
+import unittest
+
+from bay.config import Config
+from bay.docker.runner import FormationRunner
+from bay.exceptions import DockerRuntimeError, PartialRunFailure
+
+from helpers import make_instance
+
+
+class RunnerTestCase(unittest.TestCase):
+    """
+    Base for tests that need a FormationRunner without a Docker host.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def make_runner(self, host=None, keep_going=False):
+        config = Config([])
+        config.add_config({"bay": {
+            "max_workers": 4,
+            "boot_history_path": os.path.join(self.directory.name, "{prefix}", "boot_history.json"),
+            "stop_history_path": os.path.join(self.directory.name, "{prefix}", "stop_history.json"),
+        }}, "<test>")
+        app = types.SimpleNamespace(
+            config=config,
+            containers=types.SimpleNamespace(prefix="example"),
+            formation_snapshot=lambda host: None,
+        )
+        return FormationRunner(app, host=host, formation=None, task=None, keep_going=keep_going)
+
+
+class StagedExecuteTests(RunnerTestCase):
+    """
+    Tests running instances through the runner's pipeline of stages
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.lock = threading.Lock()
+        # (stage index, instance name) in the order they ran
+        self.executed = []
+
+    def recorder(self, index):
+        def executor(instance):
+            with self.lock:
+                self.executed.append((index, instance.name))
+        return executor
+
+    @staticmethod
+    def after_links(index):
+        """
+        Makes a readiness check for an instance's links having finished a stage.
+        """
+        return lambda instance, done_by_stage: all(
+            dependency in done_by_stage[index] for dependency in instance.links.values()
+        )
+
+    def test_stage_order(self):
+        db = make_instance("db")
+        web = make_instance("web", links={"db": db})
+        self.make_runner().staged_execute(
+            [db, web],
+            [
+                (lambda instance, done_by_stage: True, self.recorder(0)),
+                (self.after_links(1), self.recorder(1)),
+            ],
+        )
+        self.assertEqual(len(self.executed), 4)
+        # Each instance goes through the stages in order
+        for name in ["example.db.1", "example.web.1"]:
+            self.assertLess(self.executed.index((0, name)), self.executed.index((1, name)))
+        # And only enters one once its links are through it
+        self.assertLess(self.executed.index((1, "example.db.1")), self.executed.index((1, "example.web.1")))
+
+    def test_pipelined(self):
+        """
+        Instances get on with earlier stages while their links are still in later ones.
+        """
+        db = make_instance("db")
+        web = make_instance("web", links={"db": db})
+        web_prepared = threading.Event()
+
+        def prepare(instance):
+            if instance is web:
+                web_prepared.set()
+
+        def boot(instance):
+            # The db doesn't finish booting until web has been prepared
+            if instance is db:
+                self.assertTrue(web_prepared.wait(5))
+
+        self.make_runner().staged_execute(
+            [db, web],
+            [
+                (lambda instance, done_by_stage: True, prepare),
+                (self.after_links(1), boot),
+            ],
+        )
+
+    def test_done(self):
+        db = make_instance("db")
+        web = make_instance("web", links={"db": db})
+        self.make_runner().staged_execute(
+            [web],
+            [(self.after_links(0), self.recorder(0))],
+            done={db},
+        )
+        self.assertEqual(self.executed, [(0, "example.web.1")])
+
+    def test_failure(self):
+        def fail(instance):
+            raise ValueError("Broken")
+
+        with self.assertRaises(ValueError):
+            self.make_runner().staged_execute(
+                [make_instance("db")],
+                [(lambda instance, done_by_stage: True, fail)],
+            )
+
+    def test_deadlock(self):
+        db = make_instance("db")
+        web = make_instance("web", links={"db": db})
+        # db isn't being started, and isn't already running
+        with self.assertRaises(DockerRuntimeError) as context:
+            self.make_runner().staged_execute([web], [(self.after_links(0), self.recorder(0))])
+        self.assertIn("example.web.1", str(context.exception))
+        self.assertEqual(self.executed, [])
+
+    def make_linked(self, early):
+        db = make_instance("db")
+        web = make_instance("web", links={"db": db})
+        web.container.link_starts_early = lambda alias: early
+        return db, web
+
+    def test_waits_for_boot(self):
+        db, web = self.make_linked(early=False)
+        self.make_runner().staged_execute(
+            [db, web],
+            [
+                (lambda instance, done_by_stage: True, self.recorder(0)),
+                (FormationRunner.ready_to_launch, self.recorder(1)),
+                (lambda instance, done_by_stage: True, self.recorder(2)),
+            ],
+        )
+        self.assertLess(self.executed.index((2, "example.db.1")), self.executed.index((1, "example.web.1")))
+
+    def test_early_start(self):
+        """
+        Early-start links only need their target to be running, not booted.
+        """
+        db, web = self.make_linked(early=True)
+        web_launched = threading.Event()
+
+        def launch(instance):
+            if instance is web:
+                web_launched.set()
+
+        def boot(instance):
+            # The db doesn't finish booting until web has been started
+            if instance is db:
+                self.assertTrue(web_launched.wait(5))
+
+        self.make_runner().staged_execute(
+            [db, web],
+            [
+                (lambda instance, done_by_stage: True, self.recorder(0)),
+                (FormationRunner.ready_to_launch, launch),
+                (lambda instance, done_by_stage: True, boot),
+            ],
+        )
+
+    def test_keep_going(self):
+        """
+        A failure only holds back what depends on it; everything else still runs.
+        """
+        db = make_instance("db")
+        web = make_instance("web", links={"db": db})
+        worker = make_instance("worker", links={"web": web})
+        cache = make_instance("cache")
+        error = ValueError("Broken")
+
+        def boot(instance):
+            if instance is db:
+                raise error
+            self.recorder(1)(instance)
+
+        with self.assertRaises(PartialRunFailure) as context:
+            self.make_runner(keep_going=True).staged_execute(
+                [db, web, worker, cache],
+                [
+                    (lambda instance, done_by_stage: True, self.recorder(0)),
+                    (self.after_links(1), boot),
+                ],
+            )
+        self.assertEqual(context.exception.failures, {db: error})
+        self.assertEqual(context.exception.skipped, {web, worker})
+        self.assertEqual(
+            sorted(name for index, name in self.executed if index == 1),
+            ["example.cache.1"],
+        )
+
+
+class ReuseStoppedTests(RunnerTestCase):
+    """
+    Tests deciding if a stopped container can be started again as it is
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.removed = []
+        self.labels = {}
+        client = types.SimpleNamespace(
+            inspect_container=lambda name: {"State": {"Running": False}, "Config": {"Labels": self.labels}},
+            remove_container=self.removed.append,
+        )
+        mirror = types.SimpleNamespace(record=lambda name, state: None)
+        host = types.SimpleNamespace(client=client, state_mirror=mirror)
+        self.runner = self.make_runner(host=host)
+
+    def stopped_from(self, instance, hook_environment):
+        """
+        Labels the stopped container as if it was created from the instance,
+        with the given environment added by the pre-run hooks.
+        """
+        config_digests = instance.config_digests()
+        instance.environment.update(hook_environment)
+        self.labels = {
+            "com.eventbrite.bay.config-hash": instance.config_hash(config_digests),
+            "com.eventbrite.bay.runtime-hash": FormationRunner.runtime_hash(instance),
+        }
+
+    def test_unchanged(self):
+        self.stopped_from(make_instance("web"), {"SSH_AUTH_HOST": "10.0.0.1"})
+        instance = make_instance("web")
+        config_digests = instance.config_digests()
+        instance.environment["SSH_AUTH_HOST"] = "10.0.0.1"
+        self.assertTrue(self.runner.remove_stopped(instance, config_digests))
+        self.assertEqual(self.removed, [])
+
+    def test_hook_environment_changed(self):
+        self.stopped_from(make_instance("web"), {"SSH_AUTH_HOST": "10.0.0.1"})
+        instance = make_instance("web")
+        config_digests = instance.config_digests()
+        # The configuration is the same, but a plugin now adds something different
+        instance.environment["SSH_AUTH_HOST"] = "10.0.0.2"
+        self.assertFalse(self.runner.remove_stopped(instance, config_digests))
+        self.assertEqual(self.removed, ["example.web.1"])
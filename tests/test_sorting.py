@@ -0,0 +1,64 @@
+import unittest
+
+from bay.utils.sorting import critical_path_weights, dependency_levels, dependency_sort
+
+
+class DependencySortTests(unittest.TestCase):
+    """
+    Tests ordering nodes after their dependencies
+    """
+
+    # web needs app and cache, app needs db and cache
+    dependencies = {"web": ["app", "cache"], "app": ["db", "cache"], "db": [], "cache": [None]}
+
+    def test_sort(self):
+        self.assertEqual(
+            dependency_sort(["web"], self.dependencies.get),
+            ["cache", "db", "app", "web"],
+        )
+
+    def test_only_reachable(self):
+        self.assertEqual(dependency_sort(["app"], self.dependencies.get), ["cache", "db", "app"])
+
+    def test_levels(self):
+        self.assertEqual(
+            dependency_levels(["web"], self.dependencies.get),
+            [["cache", "db"], ["app"], ["web"]],
+        )
+
+    def test_cycle(self):
+        dependencies = {"a": ["b"], "b": ["a"], "c": []}
+        with self.assertRaises(ValueError):
+            dependency_sort(["a", "c"], dependencies.get)
+        with self.assertRaises(ValueError):
+            dependency_levels(["a", "c"], dependencies.get)
+
+
+class CriticalPathTests(unittest.TestCase):
+    """
+    Tests the critical path weighting used for boot scheduling
+    """
+
+    def test_chain_weights(self):
+        # db -> app -> web, plus a cheap standalone cache
+        dependents = {"db": {"app"}, "app": {"web"}, "web": set(), "cache": set()}
+        costs = {"db": 10, "app": 3, "web": 1, "cache": 2}
+        self.assertEqual(
+            critical_path_weights(dependents.keys(), dependents.get, costs.get),
+            {"db": 14, "app": 4, "web": 1, "cache": 2},
+        )
+
+    def test_longest_branch_wins(self):
+        dependents = {"db": {"fast", "slow"}, "fast": set(), "slow": set()}
+        costs = {"db": 1, "fast": 1, "slow": 5}
+        self.assertEqual(critical_path_weights(dependents.keys(), dependents.get, costs.get)["db"], 6)
+
+    def test_ignores_outside_nodes(self):
+        dependents = {"db": {"app", "elsewhere"}, "app": set()}
+        costs = {"db": 1, "app": 1, "elsewhere": 100}
+        self.assertEqual(critical_path_weights(dependents.keys(), dependents.get, costs.get)["db"], 2)
+
+    def test_cycle(self):
+        dependents = {"a": {"b"}, "b": {"a"}}
+        with self.assertRaises(ValueError):
+            critical_path_weights(dependents.keys(), dependents.get, lambda node: 1)
@@ -0,0 +1,197 @@
+import threading
+import time
+import unittest
+
+from bay.utils.threading import AdaptiveLimiter, ThreadSet, WorkerPool, parallel_map
+
+
+class ThreadSetTests(unittest.TestCase):
+    """
+    Tests the keyed locking in ThreadSet
+    """
+
+    def test_waiter_gets_result(self):
+        locks = ThreadSet()
+        self.assertIsNone(locks.acquire("web"))
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(locks.acquire("web")))
+        waiter.start()
+        time.sleep(0.05)
+        self.assertEqual(results, [])
+        start = time.time()
+        locks.release("web", "started")
+        waiter.join()
+        # The waiter wakes straight away rather than on a polling interval
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(results, ["started"])
+        # Nothing is kept about a value once nobody is waiting on it
+        locks.release("web")
+        self.assertEqual((locks.results, locks.waiting), ({}, {}))
+
+    def test_no_result_without_waiting(self):
+        locks = ThreadSet()
+        locks.acquire("web")
+        locks.release("web", "started")
+        # Nobody was holding it when we asked, so there's nothing to reuse
+        self.assertIsNone(locks.acquire("web"))
+
+    def test_entry_lock_passes_result(self):
+        locks = ThreadSet()
+        with locks.entry_lock("web") as outcome:
+            self.assertIsNone(outcome["previous"])
+            outcome["result"] = "stopped"
+        self.assertNotIn("web", locks)
+
+
+class WorkerPoolTests(unittest.TestCase):
+    """
+    Tests the bounded worker pool
+    """
+
+    def test_completion_reporting(self):
+        pool = WorkerPool(2)
+        results = []
+        pool.submit("a", results.append, 1)
+        pool.submit("b", results.append, 2)
+        completed = {pool.wait_for_completion(), pool.wait_for_completion()}
+        pool.shutdown()
+        self.assertEqual(completed, {("a", None), ("b", None)})
+        self.assertEqual(sorted(results), [1, 2])
+
+    def test_exception_reporting(self):
+        pool = WorkerPool(1)
+
+        def fail():
+            raise ValueError("broken")
+
+        pool.submit("a", fail)
+        key, exception = pool.wait_for_completion()
+        pool.shutdown()
+        self.assertEqual(key, "a")
+        self.assertIsInstance(exception, ValueError)
+
+    def test_size_bound(self):
+        pool = WorkerPool(2)
+        release = threading.Event()
+        for i in range(5):
+            pool.submit(i, release.wait)
+        self.assertEqual(len(pool.workers), 2)
+        release.set()
+        for _ in range(5):
+            pool.wait_for_completion()
+        pool.shutdown()
+
+    def test_priority_order(self):
+        pool = WorkerPool(1)
+        release = threading.Event()
+        order = []
+        # Occupy the only worker so the rest queue up behind it
+        pool.submit("blocker", release.wait)
+        pool.submit("low", order.append, "low", priority=1)
+        pool.submit("high", order.append, "high", priority=10)
+        release.set()
+        for _ in range(3):
+            pool.wait_for_completion()
+        pool.shutdown()
+        self.assertEqual(order, ["high", "low"])
+
+
+class ParallelMapTests(unittest.TestCase):
+    """
+    Tests the concurrent map helper
+    """
+
+    def test_results_in_order(self):
+        self.assertEqual(parallel_map(lambda x: x * 2, [3, 1, 2], size=2), [6, 2, 4])
+
+    def test_first_exception_raised(self):
+        def check(x):
+            if x > 1:
+                raise ValueError(x)
+            return x
+
+        with self.assertRaises(ValueError) as context:
+            parallel_map(check, [1, 2, 3])
+        self.assertEqual(context.exception.args, (2,))
+
+
+class AdaptiveLimiterTests(unittest.TestCase):
+    """
+    Tests the adaptive, weighted concurrency limiter
+    """
+
+    def make_limiter(self, load, **kwargs):
+        limiter = AdaptiveLimiter(load_function=lambda: load, **kwargs)
+        # Make every check eligible to adjust
+        limiter.ADJUST_INTERVAL = 0
+        return limiter
+
+    def test_weights(self):
+        limiter = self.make_limiter(None, initial=3)
+        limiter.ADJUST_INTERVAL = 60
+        limiter.acquire(2)
+        acquired = threading.Event()
+
+        def heavy():
+            limiter.acquire(2)
+            acquired.set()
+
+        thread = threading.Thread(target=heavy, daemon=True)
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+        limiter.release(2)
+        self.assertTrue(acquired.wait(1))
+
+    def test_oversized_runs_alone(self):
+        limiter = self.make_limiter(None, initial=2)
+        limiter.acquire(5)
+        self.assertEqual(limiter.in_use, 5)
+        limiter.release(5)
+        self.assertEqual(limiter.in_use, 0)
+
+    def test_backs_off_under_load(self):
+        limiter = self.make_limiter(4.0, initial=8, maximum=8)
+        limiter.record_latency(0.1)
+        self.assertEqual(limiter.capacity, 6)
+
+    def test_backs_off_when_slow(self):
+        limiter = self.make_limiter(0.1, initial=8, maximum=8)
+        limiter.record_latency(0.1)
+        limiter.record_latency(5)
+        self.assertLess(limiter.capacity, 8)
+
+    def test_operations_have_own_baselines(self):
+        limiter = self.make_limiter(0.3, initial=4, maximum=4)
+        # Starts are always much slower than creates, which shouldn't count as being overloaded
+        for _ in range(5):
+            limiter.record_latency(0.04, "create")
+            limiter.record_latency(0.4, "start")
+        self.assertEqual(limiter.capacity, 4)
+
+    def test_priority_order(self):
+        limiter = self.make_limiter(None, initial=1)
+        limiter.ADJUST_INTERVAL = 60
+        limiter.acquire()
+        order = []
+
+        def waiter(name, priority):
+            limiter.acquire(priority=priority)
+            order.append(name)
+            limiter.release()
+
+        threads = []
+        for name, priority in [("low", 1), ("high", 5), ("middle", 3)]:
+            threads.append(threading.Thread(target=waiter, args=(name, priority), daemon=True))
+            threads[-1].start()
+            time.sleep(0.05)
+        limiter.release()
+        for thread in threads:
+            thread.join(1)
+        self.assertEqual(order, ["high", "middle", "low"])
+
+    def test_grows_when_idle(self):
+        limiter = self.make_limiter(0.1, initial=2, maximum=4)
+        limiter.record_latency(0.1)
+        limiter.record_latency(0.1)
+        limiter.record_latency(0.1)
+        self.assertEqual(limiter.capacity, 4)
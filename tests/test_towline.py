@@ -0,0 +1,61 @@
+import types
+import unittest
+
+from bay.docker.logs import follow_output, parse_timestamp
+from bay.docker.towline import Towline
+
+
+class StreamLineTests(unittest.TestCase):
+    """
+    Tests picking towline statuses out of container output
+    """
+
+    def test_progress(self):
+        self.assertEqual(
+            Towline._parse_stream_line(b'{"towline": 2, "message": "Migrating:"}'),
+            (None, "Migrating"),
+        )
+
+    def test_complete(self):
+        self.assertEqual(
+            Towline._parse_stream_line(b'{"towline": 2, "complete": true}'),
+            (True, "Towline boot complete"),
+        )
+        self.assertEqual(
+            Towline._parse_stream_line(b'{"towline": 2, "complete": false, "message": "No database"}'),
+            (False, "No database"),
+        )
+
+    def test_other_output(self):
+        self.assertIsNone(Towline._parse_stream_line(b"Starting server"))
+        self.assertIsNone(Towline._parse_stream_line(b'{"level": "info"}'))
+        self.assertIsNone(Towline._parse_stream_line(b"{not json"))
+
+
+class FollowOutputTests(unittest.TestCase):
+    """
+    Tests that following output skips what a reused container printed last time
+    """
+
+    def test_skips_previous_runs(self):
+        calls = {}
+
+        def logs(name, **kwargs):
+            calls.update(kwargs)
+            return iter([
+                b"2017-09-01T12:00:05.900000000Z old complete\n2017-09-01T12:00:06.1Z new",
+                b" line\n2017-09-01T12:00:07Z done\n",
+            ])
+
+        client = types.SimpleNamespace(
+            inspect_container=lambda name: {"State": {"StartedAt": "2017-09-01T12:00:06.05Z"}},
+            logs=logs,
+        )
+        lines = list(follow_output(types.SimpleNamespace(client=client), "example.web.1"))
+        self.assertEqual(lines, [b"new line", b"done"])
+        self.assertEqual(calls["since"], parse_timestamp("2017-09-01T12:00:06Z")[0])
+
+    def test_parse_timestamp(self):
+        self.assertLess(parse_timestamp("2017-09-01T12:00:06.05Z"), parse_timestamp("2017-09-01T12:00:06.1Z"))
+        with self.assertRaises(ValueError):
+            parse_timestamp("2017-09-01T12:00:06+01:00")
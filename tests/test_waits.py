@@ -0,0 +1,97 @@
+import threading
+import time
+import types
+import unittest
+
+from bay.exceptions import ContainerBootFailure
+from bay.plugins.waits import LogWait, TcpWait, TimeWait, WaitsPlugin
+
+
+class FakeWatcher:
+    """
+    Stands in for a host's ContainerEventWatcher, letting tests send events.
+    """
+
+    def __init__(self):
+        self.watchers = {}
+
+    def watch(self, name, callback, events=("die",)):
+        self.watchers[name] = callback
+        return name
+
+    def unwatch(self, name, handle):
+        self.watchers.pop(name, None)
+
+    def send(self, name, event):
+        self.watchers[name](event)
+
+
+def make_task():
+    return types.SimpleNamespace(subtasks=[], update=lambda *args, **kwargs: None)
+
+
+class PostStartTests(unittest.TestCase):
+    """
+    Tests running a container's waits after it starts
+    """
+
+    def setUp(self):
+        self.running = True
+        self.host = types.SimpleNamespace(
+            event_watcher=FakeWatcher(),
+            container_running=lambda name: self.running,
+        )
+        app = types.SimpleNamespace(
+            get_catalog_items=lambda type_name: {"time": TimeWait, "tcp": TcpWait, "log": LogWait},
+            config={"bay": {"infer_healthcheck_waits": False}},
+        )
+        self.plugin = WaitsPlugin(app)
+
+    def make_instance(self, *waits, boot_deadline=None):
+        container = types.SimpleNamespace(name="web", waits=list(waits), infer_healthcheck=False)
+        return types.SimpleNamespace(name="example.web.1", container=container, boot_deadline=boot_deadline)
+
+    def test_finishes(self):
+        self.plugin.post_start(self.host, self.make_instance({"type": "time", "params": {"seconds": 0}}), make_task())
+
+    def test_wait_deadline(self):
+        instance = self.make_instance({"type": "time", "params": {"seconds": 60, "deadline": 0.2}})
+        start = time.time()
+        with self.assertRaises(ContainerBootFailure):
+            self.plugin.post_start(self.host, instance, make_task())
+        self.assertLess(time.time() - start, 5)
+
+    def test_boot_deadline(self):
+        instance = self.make_instance({"type": "time", "params": {"seconds": 60}}, boot_deadline=time.time() + 0.2)
+        with self.assertRaises(ContainerBootFailure):
+            self.plugin.post_start(self.host, instance, make_task())
+
+    def test_timeout_goes_to_wait(self):
+        # "timeout" is the wait's own setting (like tcp's per-attempt connect timeout), not a deadline
+        instance = self.make_instance({"type": "tcp", "params": {"port": 80, "timeout": 0.1}})
+        created = []
+
+        class RecordingWait(TcpWait):
+            def ready(self):
+                created.append(self)
+                return True
+
+        self.plugin.app.get_catalog_items = lambda type_name: {"tcp": RecordingWait}
+        self.plugin.post_start(self.host, instance, make_task())
+        self.assertEqual(created[0].timeout, 0.1)
+
+    def test_death(self):
+        # A death fails the boot even if Docker still says it's running, as its event is the latest word
+        instance = self.make_instance({"type": "time", "params": {"seconds": 60}})
+        threading.Timer(0.2, lambda: self.host.event_watcher.send(instance.name, {"Action": "die"})).start()
+        start = time.time()
+        with self.assertRaises(ContainerBootFailure):
+            self.plugin.post_start(self.host, instance, make_task())
+        self.assertLess(time.time() - start, 5)
+
+    def test_stream_lost(self):
+        instance = self.make_instance({"type": "time", "params": {"seconds": 60}})
+        threading.Timer(0.2, lambda: self.host.event_watcher.send(instance.name, None)).start()
+        threading.Timer(0.4, lambda: setattr(self, "running", False)).start()
+        with self.assertRaises(ContainerBootFailure):
+            self.plugin.post_start(self.host, instance, make_task())